@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 18:12:44 2026
+
+align the behavioural events (PsychoPy clock) to the MEG triggers.
+
+The localizer images, cues and sequence images each sent a trigger with
+the stimulus in its value. These rows of the behavioural events are
+matched to the triggers with the same value by sorted-array search, a
+linear model (offset and clock drift) is fitted to the matched pairs and
+used to put all behavioural onsets on the MEG clock.
+
+@author: simon.kern
+"""
+import numpy as np
+from events_conversion import stimuli
+
+# added to the index of the stimulus (1-5) to get the trigger value
+trigger_offsets = {('localizer', 'stimulus'): 0,
+                   ('sequence', 'cue'): 10,
+                   ('sequence', 'stimulus'): 20}
+# upside-down localizer images are sent with +100, same timing otherwise
+distractor_offset = 100
+
+
+def expected_triggers(df):
+    """trigger value that each behavioural event should have sent, 0 for
+    events without trigger"""
+    stim_index = df['stim_label'].astype(str).str.lower().map(
+        {stim: i for i, stim in enumerate(stimuli, 1)}).fillna(0).to_numpy(int)
+    values = np.zeros(len(df), dtype=int)
+    for (condition, trial_type), offset in trigger_offsets.items():
+        rows = ((df['condition']==condition) & (df['trial_type']==trial_type)).to_numpy()
+        values[rows] = stim_index[rows] + offset
+    values[(stim_index==0) | np.isnan(df['onset'].to_numpy(float))] = 0
+    return values
+
+
+def match(onsets, values, trigger_times, trigger_values, intercept, slope, tolerance):
+    """index of the trigger with the same value that is closest to each
+    predicted onset (intercept + slope*onset), -1 if there is none within
+    `tolerance` seconds. Each trigger is matched to at most one onset.
+
+    Returns
+    -------
+    closest : trigger index per onset
+    residuals : trigger time - predicted onset, NaN if not matched
+    """
+    predicted = intercept + slope * onsets
+    # sort the triggers by (value, time) in a single key, the values are
+    # spaced further apart than any two times, so the closest key always
+    # has the same value if it is within the tolerance
+    span = 2 * np.nanmax(np.abs(np.r_[trigger_times, predicted])) + 2*tolerance + 1
+    keys = trigger_values * span + trigger_times
+    order = np.argsort(keys)
+    keys_sorted = keys[order]
+    query = values * span + predicted
+
+    idx = np.searchsorted(keys_sorted, query)
+    left = np.clip(idx - 1, 0, len(keys) - 1)
+    right = np.clip(idx, 0, len(keys) - 1)
+    dist_left = np.abs(keys_sorted[left] - query)
+    dist_right = np.abs(keys_sorted[right] - query)
+    closest = np.where(dist_left<=dist_right, left, right)
+    dist = np.minimum(dist_left, dist_right)
+    closest = np.where((values>0) & (dist<=tolerance), order[closest], -1)
+
+    # if several onsets matched the same trigger only keep the closest one
+    by_dist = np.argsort(np.where(closest>=0, dist, np.inf), kind='stable')
+    _, first = np.unique(closest[by_dist], return_index=True)
+    keep = np.zeros(len(closest), dtype=bool)
+    keep[by_dist[first]] = True
+    closest = np.where(keep, closest, -1)
+
+    residuals = np.where(closest>=0, trigger_times[closest] - predicted, np.nan)
+    return closest, residuals
+
+
+def estimate_intercept(onsets, values, trigger_times, trigger_values, window=0.1):
+    """coarse offset between the clocks: the most frequent difference
+    between trigger times and onsets of the same value, i.e. the start of
+    the `window` that contains most of these differences"""
+    diffs = [np.subtract.outer(trigger_times[trigger_values==value],
+                               onsets[values==value]).ravel()
+             for value in np.unique(values[values>0])]
+    diffs = np.sort(np.concatenate(diffs))
+    if len(diffs)==0:
+        return np.nan
+    counts = np.searchsorted(diffs, diffs + window) - np.arange(len(diffs))
+    start = np.argmax(counts)
+    return np.median(diffs[start:start + counts[start]])
+
+
+def align_to_meg(df, trigger_times, trigger_values, tolerance=0.02, min_matched=0.5,
+                 max_iter=20):
+    """put the behavioural events on the MEG clock.
+
+    Parameters
+    ----------
+    df : behavioural events of one subject, see convert_psychopy_to_bids
+    trigger_times : time of each MEG trigger in seconds since the first
+                    sample, as the onsets in the MEG events.tsv
+    trigger_values : value of each MEG trigger
+    tolerance : max. residual in seconds of a matched trigger
+    min_matched : fraction of the expected triggers that need to be
+                  matched, otherwise the alignment is considered failed
+    max_iter : max. number of refits while the matched events grow
+
+    Returns
+    -------
+    df : copy of df with the columns onset_meg (onset on the MEG clock,
+         NaN if the alignment failed) and trigger_residual (trigger time -
+         fitted onset, NaN for events without matched trigger)
+    stats : dict with the fitted model and residual statistics
+    """
+    df = df.copy()
+    onsets = df['onset'].to_numpy(float)
+    values = expected_triggers(df)
+    trigger_times = np.asarray(trigger_times, dtype=float)
+    trigger_values = np.asarray(trigger_values, dtype=int)
+    trigger_values = np.where(trigger_values>distractor_offset,
+                              trigger_values - distractor_offset, trigger_values)
+    relevant = np.isin(trigger_values, values[values>0])
+    trigger_times = trigger_times[relevant]
+    trigger_values = trigger_values[relevant]
+
+    stats = {'n_expected': int((values>0).sum()), 'n_triggers': int(relevant.sum()),
+             'n_matched': 0, 'aligned': False}
+    intercept, slope = np.nan, 1.0
+    if stats['n_expected'] and stats['n_triggers']:
+        intercept = estimate_intercept(onsets, values, trigger_times, trigger_values)
+        # the coarse offset only fits part of the session if the clocks
+        # drift, so match wide and refit until no further events match
+        n_matched = 0
+        for tol in [0.1]*max_iter + [tolerance]:
+            closest, _ = match(onsets, values, trigger_times, trigger_values,
+                               intercept, slope, tol)
+            matched = closest>=0
+            if matched.sum()<2:
+                break
+            if tol!=tolerance and matched.sum()==n_matched:
+                continue  # converged, do the final fit with the tolerance
+            slope, intercept = np.polyfit(onsets[matched], trigger_times[closest[matched]], 1)
+            n_matched = matched.sum()
+        closest, residuals = match(onsets, values, trigger_times, trigger_values,
+                                   intercept, slope, tolerance)
+        matched = closest>=0
+        stats |= {'n_matched': int(matched.sum()),
+                  'aligned': bool(matched.sum()>=max(2, min_matched*stats['n_expected']))}
+
+    if stats['aligned']:
+        res_ms = residuals[matched] * 1000
+        stats |= {'intercept': float(intercept),
+                  'drift_ppm': float((slope - 1) * 1e6),
+                  'residual_mean_ms': float(res_ms.mean()),
+                  'residual_std_ms': float(res_ms.std()),
+                  'residual_max_ms': float(np.abs(res_ms).max())}
+        df['onset_meg'] = intercept + slope * onsets
+        df['trigger_residual'] = residuals
+    else:
+        df['onset_meg'] = np.nan
+        df['trigger_residual'] = np.nan
+    return df, stats
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 17:31:09 2026
+
+the behavioural events of all subjects as one typed, columnar dataset.
+
+The *_beh.tsv of every subject is stored as one parquet file, partitioned
+by subject (derivatives/beh-dataset/subject=sub-XX/data.parquet), so that
+only subjects whose tsv changed need to be rewritten. Group analyses load
+the dataset with `load`, which only reads the requested columns and
+subjects/conditions.
+
+@author: simon.kern
+"""
+import os
+import glob
+import json
+import shutil
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# columns with few distinct values, stored as dictionary encoded strings
+categorical = ['condition', 'trial_type', 'stim_label', 'key_down', 'key_expected']
+# True/False columns that contain NaN for trials without a response
+boolean = ['accuracy', 'key_pressed']
+integer = ['session']
+
+partitioning = ds.partitioning(pa.schema([('subject', pa.string())]), flavor='hive')
+
+
+def get_dataset_dir(bids_root):
+    return f'{bids_root}/derivatives/beh-dataset/'
+
+
+def to_boolean(values):
+    """True/False/NaN as nullable booleans. The tsv contains 'True', 'False'
+    and, for some trials, 1.0/0.0"""
+    mapping = {'True': True, 'False': False, '1.0': True, '0.0': False,
+               True: True, False: False}
+    return pa.array([mapping.get(v, None) for v in values], pa.bool_())
+
+
+def to_table(df):
+    """convert the events of one subject to an arrow table with fixed types"""
+    arrays = {}
+    for col in df.columns:
+        values = df[col]
+        if col in categorical:
+            values = values.astype(object).where(values.notna(), None)
+            arrays[col] = pa.array(values, pa.string()).dictionary_encode()
+        elif col in boolean:
+            arrays[col] = to_boolean(values)
+        elif col in integer:
+            arrays[col] = pa.array(values.astype('Int64'), pa.int64())
+        elif pd.api.types.is_numeric_dtype(values):
+            arrays[col] = pa.array(values, pa.float64())
+        else:
+            arrays[col] = pa.array(values.astype(object).where(values.notna(), None), pa.string())
+    return pa.table(arrays)
+
+
+def write_subject(df, subject, dataset_dir):
+    """write the partition of one subject, replacing it atomically"""
+    part_dir = f'{dataset_dir}/subject={subject}/'
+    os.makedirs(part_dir, exist_ok=True)
+    # files starting with '.' are ignored when the dataset is read
+    pq.write_table(to_table(df.drop(columns='subject', errors='ignore')),
+                   f'{part_dir}/.data.parquet.tmp')
+    os.replace(f'{part_dir}/.data.parquet.tmp', f'{part_dir}/data.parquet')
+
+
+def update(bids_root, dataset_dir=None):
+    """write the partitions of all subjects whose *_beh.tsv changed since
+    the last update and remove partitions of subjects without tsv.
+
+    Returns
+    -------
+    list of the updated subjects
+    """
+    dataset_dir = dataset_dir or get_dataset_dir(bids_root)
+    sources_file = f'{dataset_dir}/_sources.json'
+    sources = {}
+    if os.path.isfile(sources_file):
+        with open(sources_file, 'r') as f:
+            sources = json.load(f)
+
+    tsv_files = sorted(glob.glob(f'{bids_root}/sub-*/beh/sub-*_task-main_beh.tsv'))
+    subjects = {os.path.basename(f).split('_')[0]: f for f in tsv_files}
+    updated = []
+    for subject, tsv_file in subjects.items():
+        stat = os.stat(tsv_file)
+        if sources.get(subject)==[stat.st_size, stat.st_mtime] and \
+            os.path.isfile(f'{dataset_dir}/subject={subject}/data.parquet'):
+            continue
+        write_subject(pd.read_csv(tsv_file, sep='\t'), subject, dataset_dir)
+        sources[subject] = [stat.st_size, stat.st_mtime]
+        updated += [subject]
+
+    for part_dir in glob.glob(f'{dataset_dir}/subject=*'):
+        subject = os.path.basename(part_dir.rstrip('/')).split('=', 1)[-1]
+        if subject not in subjects:
+            shutil.rmtree(part_dir)
+            sources.pop(subject, None)
+
+    os.makedirs(dataset_dir, exist_ok=True)
+    with open(sources_file + '.tmp', 'w') as f:
+        json.dump(sources, f, indent=1)
+    os.replace(sources_file + '.tmp', sources_file)
+    return updated
+
+
+def load(dataset_dir, columns=None, subjects=None, conditions=None, filter=None):
+    """load the behavioural events of several subjects.
+
+    Only the requested columns are read and the subject and condition
+    filters are applied while reading, so partitions of other subjects
+    aren't opened at all.
+
+    Parameters
+    ----------
+    dataset_dir : folder of the dataset, see `get_dataset_dir`
+    columns : list of columns to load, None for all
+    subjects : list of subjects to load, e.g. ['sub-01', 'sub-02']
+    conditions : list of conditions to load, e.g. ['localizer']
+    filter : further pyarrow.dataset expression, e.g.
+             ds.field('trial_type')=='stimulus'
+
+    Returns
+    -------
+    pd.DataFrame with one row per event, categorical string columns and
+    nullable boolean columns
+    """
+    dataset = ds.dataset(dataset_dir, format='parquet', partitioning=partitioning)
+    expressions = [] if filter is None else [filter]
+    if subjects is not None:
+        expressions += [ds.field('subject').isin(list(subjects))]
+    if conditions is not None:
+        expressions += [ds.field('condition').isin(list(conditions))]
+    expression = None
+    for expr in expressions:
+        expression = expr if expression is None else expression & expr
+    table = dataset.to_table(columns=columns, filter=expression)
+    return table.to_pandas(types_mapper={pa.bool_(): pd.BooleanDtype()}.get)
+
+
+if __name__=='__main__':
+    bids_root = os.path.abspath(os.path.dirname(__file__) + '/../')
+    updated = update(bids_root)
+    print(f'updated {len(updated)} subjects: {updated}')
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 20:46:52 2026
+
+benchmark of the conversion on synthetic inputs, runs offline.
+
+Times convert_psychopy_to_bids, check_and_fix_channels and the conversion
+of a whole subject (convert_to_bids.py on a synthetic raw data folder) for
+several input sizes. The best of `--repeat` runs is compared to the
+baselines in benchmark_baselines.json, the script exits with 1 if any of
+them got slower by more than `--tolerance`.
+
+The baselines depend on the machine, so they are stored per machine and
+only compared on the machine they were recorded on. On a new machine or
+after an intended change of speed they are recorded with --update-baselines.
+
+    python code/benchmark.py --quick
+    python code/benchmark.py --only events_conversion --repeat 5
+
+@author: simon.kern
+"""
+import os
+import sys
+import json
+import glob
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from functools import partial
+import pandas as pd
+import mne
+import misc
+import instrument
+import synthetic
+import events_conversion
+
+code_dir = os.path.dirname(os.path.abspath(__file__))
+baseline_file = f'{code_dir}/benchmark_baselines.json'
+
+# input sizes of each benchmark
+sizes = {'events_conversion': [100, 400, 1600],  # trials of the run
+         'check_and_fix_channels': [60, 300],  # seconds of recording
+         'check_and_fix_channels_memmap': [300],
+         'convert_subject': [40, 120],  # localizer trials of the main task
+         }
+
+
+def bench_events_conversion(work_dir, n_trials, repeat, info=None, missing=()):
+    basename = f'{work_dir}/beh/01_main_2023-11-14_10h31.25.123_{n_trials}'
+    os.makedirs(os.path.dirname(basename), exist_ok=True)
+    csv_file = synthetic.make_psychopy_run(basename, n_localizer=n_trials - n_trials//4,
+                                           n_sequence=n_trials//4)
+    for _ in range(repeat):
+        with instrument.stage('events_conversion', size=n_trials):
+            events_conversion.convert_psychopy_to_bids(csv_file)
+    return instrument.collect()
+
+
+def bench_check_and_fix_channels(work_dir, duration, repeat, info, missing, memmap=False):
+    fif_file = synthetic.make_raw_fif(f'{work_dir}/meg/fix_{duration}s_raw.fif', info,
+                                      duration, missing=missing)
+    preload = f'{work_dir}/meg/fix_{duration}s.dat' if memmap else True
+    for _ in range(repeat):
+        # the interpolation matrix is cached, clear it to time the cold path
+        shutil.rmtree(misc.cache_dir, ignore_errors=True)
+        raw = mne.io.read_raw_fif(fif_file, verbose='ERROR')
+        with instrument.stage('check_and_fix_channels',
+                              size=f'{duration}, memmap' if memmap else duration):
+            misc.check_and_fix_channels(raw, preload=preload)
+        del raw
+    return instrument.collect()
+
+
+def bench_convert_subject(work_dir, n_localizer, repeat, info, missing):
+    """run convert_to_bids.py on a raw data folder with one subject, the
+    time is the convert_subject stage of its run report"""
+    raw_dir = synthetic.make_raw_folder(f'{work_dir}/raw-{n_localizer}', info, ['01'],
+                                        n_localizer, n_localizer//4, missing=missing)
+    records = []
+    for i in range(repeat):
+        run_dir = f'{work_dir}/run-{n_localizer}-{i}'
+        # a fresh home, so that nothing is read from the caches of the last run
+        env = os.environ | {'HOME': f'{run_dir}/home'}
+        cmd = [sys.executable, f'{code_dir}/convert_to_bids.py', '--force',
+               '--raw-folder', raw_dir, '--bids-root', f'{run_dir}/bids',
+               '--report-dir', f'{run_dir}/report', '--scratch', f'{run_dir}/scratch']
+        proc = subprocess.run(cmd, cwd=work_dir, env=env, capture_output=True, text=True)
+        report_files = glob.glob(f'{run_dir}/report/run-*.json')
+        if proc.returncode or not report_files:
+            raise RuntimeError(f'convert_to_bids.py failed:\n{proc.stdout[-3000:]}{proc.stderr[-3000:]}')
+        with open(report_files[0], 'r') as f:
+            report = json.load(f)
+        if report['errors']:
+            raise RuntimeError(f'convert_to_bids.py failed: {report["errors"]}')
+        stages = pd.DataFrame(report['stages'])
+        record = stages[stages['stage']=='convert_subject'].iloc[0].to_dict()
+        records += [record | {'size': n_localizer}]
+        shutil.rmtree(run_dir)
+    return records
+
+
+benchmarks = {'events_conversion': bench_events_conversion,
+              'check_and_fix_channels': bench_check_and_fix_channels,
+              'check_and_fix_channels_memmap': partial(bench_check_and_fix_channels, memmap=True),
+              'convert_subject': bench_convert_subject}
+
+
+def load_baselines(baseline_file=baseline_file):
+    """timings of each benchmark and size, by machine, see `get_machine`"""
+    if not os.path.isfile(baseline_file):
+        return {}
+    with open(baseline_file, 'r') as f:
+        return json.load(f)
+
+
+def get_machine():
+    """the machine the timings are only comparable on"""
+    return f'{platform.node()}, {platform.processor() or "unknown processor"}, ' \
+           f'{os.cpu_count()} CPUs, python {platform.python_version()}'
+
+
+def compare(results, timings, tolerance):
+    """best time of each benchmark and size against its baseline.
+
+    Returns
+    -------
+    pd.DataFrame with one row per benchmark and size and the column
+    'regression', which is True if it is slower than the baseline by more
+    than `tolerance` (fraction)
+    """
+    df = results.groupby(['stage', 'size'], sort=False).agg(
+        best_s=('wall_s', 'min'), rss_peak_mb=('rss_peak_mb', 'max')).reset_index()
+    df['name'] = df['stage'] + '[' + df['size'].astype(str) + ']'
+    df['baseline_s'] = df['name'].map(timings).astype(float)
+    df['change'] = df['best_s'] / df['baseline_s'] - 1
+    df['regression'] = df['change']>tolerance
+    return df
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='benchmark the conversion on synthetic inputs')
+    parser.add_argument('--only', nargs='+', choices=list(benchmarks), default=list(benchmarks),
+                        help='only run these benchmarks')
+    parser.add_argument('--quick', action='store_true', help='only run the smallest size')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per size, the best counts')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='fraction by which a benchmark may be slower than its baseline')
+    parser.add_argument('--update-baselines', action='store_true',
+                        help='store the times of this run as the new baselines')
+    parser.add_argument('--baselines', default=baseline_file, help='json file of the baselines')
+    parser.add_argument('--template', default='template-info.fif',
+                        help='info of the recordings, synthetic channels if it does not exist')
+    parser.add_argument('--missing', nargs='*', default=['MEG2112', 'BIO003'],
+                        help='channels that are removed from the recordings')
+    parser.add_argument('--work-dir', default=None,
+                        help='folder for the synthetic inputs, default: a temporary folder')
+    args = parser.parse_args()
+
+    work_dir = os.path.abspath(args.work_dir or tempfile.mkdtemp(prefix='benchmark-'))
+    os.makedirs(work_dir, exist_ok=True)
+    if os.path.isfile(args.template):
+        shutil.copy(args.template, f'{work_dir}/template-info.fif')
+    else:
+        print(f'{args.template} not found, using synthetic channels')
+        mne.io.write_info(f'{work_dir}/template-info.fif', synthetic.make_info())
+    # check_and_fix_channels reads the template from the working directory
+    os.chdir(work_dir)
+    misc.cache_dir = f'{work_dir}/cache/'
+    info = mne.io.read_info(f'{work_dir}/template-info.fif', verbose='ERROR')
+
+    records = []
+    for name in args.only:
+        for size in sizes[name][:1] if args.quick else sizes[name]:
+            print(f'running {name}[{size}]')
+            records += benchmarks[name](work_dir, size, args.repeat, info=info,
+                                        missing=args.missing)
+    if args.work_dir is None:
+        shutil.rmtree(work_dir)
+
+    baselines = load_baselines(args.baselines)
+    machine = get_machine()
+    if machine not in baselines and not args.update_baselines:
+        print(f'WARNING: no baselines for this machine ({machine}), nothing is compared. '
+              f'Record them with --update-baselines')
+    timings = baselines.get(machine, {})
+    df = compare(pd.DataFrame(records), timings, args.tolerance)
+    print(df.drop(columns=['stage', 'size']).set_index('name').round(3).to_string())
+
+    if args.update_baselines:
+        baselines[machine] = timings | dict(zip(df['name'], df['best_s'].round(4)))
+        with open(args.baselines, 'w') as f:
+            json.dump(baselines, f, indent=1)
+        print(f'baselines written to {args.baselines}')
+    elif df['regression'].any():
+        print(f'REGRESSION: {list(df["name"][df["regression"]])} slower than '
+              f'their baselines by more than {args.tolerance:.0%}')
+        sys.exit(1)
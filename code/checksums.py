@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 22:05:13 2026
+
+checksums of all files of the dataset, to verify the outputs of the
+conversion and replicas of the dataset on other storage.
+
+The sha256, size and mtime of every file are stored in checksums.json at
+the dataset root. Files matched by .bidsignore or .gitignore (e.g. the
+venv/ of `make install`) and hidden files are skipped. Files are hashed in
+parallel threads, each read through a memory map in chunks.
+
+    python code/checksums.py update   # hash new and changed files
+    python code/checksums.py verify   # re-hash files whose size/mtime changed
+    python code/checksums.py verify --full   # e.g. on a replica
+    python code/checksums.py diff old_checksums.json   # for CHANGES
+
+@author: simon.kern
+"""
+import os
+import sys
+import mmap
+import json
+import time
+import hashlib
+import argparse
+from fnmatch import fnmatchcase
+from tqdm import tqdm
+from joblib import Parallel, delayed
+
+checksum_file = 'checksums.json'
+# never part of the checksums, in addition to the patterns of .bidsignore
+# and .gitignore. venv/ is created by `make install`
+default_ignore = ['.*', '__pycache__/', 'venv/', checksum_file]
+
+
+def hash_file(file, chunk_size=2**24):
+    """sha256 of a file, read through a memory map in chunks"""
+    sha256 = hashlib.sha256()
+    with open(file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size==0:
+            return sha256.hexdigest()  # empty files can't be mapped
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if hasattr(m, 'madvise'):
+                m.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(m)
+            try:
+                for start in range(0, len(view), chunk_size):
+                    sha256.update(view[start:start + chunk_size])
+            finally:
+                view.release()
+    return sha256.hexdigest()
+
+
+def read_ignore(root, name='.bidsignore'):
+    """patterns of an ignore file at the root of the dataset, negations
+    (!pattern) are not supported and skipped"""
+    if not os.path.isfile(f'{root}/{name}'):
+        return []
+    with open(f'{root}/{name}', 'r') as f:
+        return [line.strip() for line in f
+                if line.strip() and not line.startswith(('#', '!'))]
+
+
+def is_ignored(rel_path, patterns):
+    """whether a file matches one of the .gitignore-style patterns. Patterns
+    without a slash match the name of the file or any of its folders,
+    patterns with a slash the path from the root, patterns ending in a
+    slash only folders"""
+    parts = rel_path.split('/')
+    for pattern in patterns:
+        anchored = '/' in pattern.rstrip('/')
+        n_parts = len(parts) - 1 if pattern.endswith('/') else len(parts)
+        pattern = pattern.strip('/')
+        for n in range(1, n_parts + 1):
+            name = '/'.join(parts[:n]) if anchored else parts[n-1]
+            if fnmatchcase(name, pattern):
+                return True
+    return False
+
+
+def list_files(root):
+    """relative paths of all files of the dataset that are not ignored"""
+    patterns = default_ignore + read_ignore(root, '.bidsignore') + read_ignore(root, '.gitignore')
+    files = []
+    for folder, dirs, names in os.walk(root):
+        rel_folder = os.path.relpath(folder, root).replace(os.sep, '/')
+        rel_folder = '' if rel_folder=='.' else f'{rel_folder}/'
+        # skip ignored folders without listing them
+        dirs[:] = [d for d in dirs if not is_ignored(f'{rel_folder}{d}/', patterns)]
+        files += [f'{rel_folder}{name}' for name in names
+                  if not is_ignored(f'{rel_folder}{name}', patterns)]
+    return sorted(files)
+
+
+def load(root):
+    """the stored checksums of the dataset, {} if there are none"""
+    if not os.path.isfile(f'{root}/{checksum_file}'):
+        return {}
+    with open(f'{root}/{checksum_file}', 'r') as f:
+        return json.load(f)['files']
+
+
+def compute(root, files, previous=None, n_jobs=8):
+    """size, mtime and sha256 of the files, in parallel threads.
+
+    Parameters
+    ----------
+    root : root of the dataset
+    files : relative paths of the files
+    previous : checksums of an earlier run, their sha256 is reused for
+               files whose size and mtime didn't change
+    n_jobs : number of files that are hashed at the same time
+
+    Returns
+    -------
+    dict with relative path -> {'size', 'mtime', 'sha256'}
+    """
+    previous = previous or {}
+    checksums, todo = {}, []
+    for file in files:
+        stat = os.stat(f'{root}/{file}')
+        sig = {'size': stat.st_size, 'mtime': stat.st_mtime}
+        prev = previous.get(file, {})
+        if all(prev.get(k)==v for k, v in sig.items()):
+            checksums[file] = sig | {'sha256': prev['sha256']}
+        else:
+            checksums[file] = sig
+            todo.append(file)
+
+    # largest files first, so that no thread is left with one large file at the end
+    todo = sorted(todo, key=lambda file: -checksums[file]['size'])
+    results = Parallel(n_jobs=n_jobs, prefer='threads', return_as='generator_unordered')(
+        delayed(lambda file: (file, hash_file(f'{root}/{file}')))(file) for file in todo)
+    for file, sha256 in tqdm(results, total=len(todo), desc='hashing'):
+        checksums[file]['sha256'] = sha256
+    return checksums
+
+
+def update(root, n_jobs=8):
+    """hash new and changed files and write checksums.json.
+
+    Returns
+    -------
+    the differences to the previous checksums, see `diff`
+    """
+    previous = load(root)
+    checksums = compute(root, list_files(root), previous, n_jobs=n_jobs)
+    tmp_file = f'{root}/.{checksum_file}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump({'algorithm': 'sha256', 'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'files': checksums}, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, f'{root}/{checksum_file}')
+    return diff(previous, checksums)
+
+
+def verify(root, full=False, n_jobs=8):
+    """compare the files of the dataset to checksums.json, without writing.
+
+    Only files whose size or mtime changed are re-hashed, all files if
+    `full`, e.g. for a replica on other storage.
+
+    Returns
+    -------
+    the differences to the stored checksums, see `diff`
+    """
+    stored = load(root)
+    current = compute(root, list_files(root), None if full else stored, n_jobs=n_jobs)
+    return diff(stored, current)
+
+
+def diff(old, new):
+    """files that were added, removed or modified between two checksums
+
+    Returns
+    -------
+    dict with 'added', 'removed' and 'modified', each a sorted list of
+    relative paths
+    """
+    return {'added': sorted(new.keys() - old.keys()),
+            'removed': sorted(old.keys() - new.keys()),
+            'modified': sorted(file for file in old.keys() & new.keys()
+                               if old[file]['sha256']!=new[file]['sha256'])}
+
+
+def format_changes(changes, version, max_files=5):
+    """an entry for the CHANGES file, grouped by folder (e.g. sub-01/meg)"""
+    lines = [f'{version} {time.strftime("%Y-%m-%d")}']
+    for kind in ['added', 'removed', 'modified']:
+        folders = {}
+        for file in changes[kind]:
+            folders.setdefault(os.path.dirname(file) or '.', []).append(os.path.basename(file))
+        for folder, names in sorted(folders.items()):
+            if len(names)>max_files:
+                names = names[:max_files] + [f'and {len(names) - max_files} more']
+            lines += [f'\t- {kind} in {folder}: {", ".join(names)}']
+    if len(lines)==1:
+        lines += ['\t- no changes of the data']
+    return '\n'.join(lines)
+
+
+def print_changes(changes):
+    for kind, files in changes.items():
+        for file in files:
+            print(f'{kind:>8}: {file}')
+    print(', '.join(f'{len(files)} {kind}' for kind, files in changes.items()))
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='checksums of all files of the dataset')
+    parser.add_argument('mode', choices=['update', 'verify', 'diff'])
+    parser.add_argument('old', nargs='?', default=None,
+                        help='diff: checksums of the last release, e.g. from '
+                             'git show v1.0.0:checksums.json > old.json')
+    parser.add_argument('--root', default=os.path.abspath(os.path.dirname(__file__) + '/../'),
+                        help='root of the dataset')
+    parser.add_argument('--full', action='store_true',
+                        help='verify: re-hash all files, not only the ones whose size or mtime changed')
+    parser.add_argument('--version', default='x.x.x',
+                        help='diff: version of the CHANGES entry')
+    parser.add_argument('--n-jobs', type=int, default=8, help='files hashed at the same time')
+    args = parser.parse_args()
+
+    if args.mode=='update':
+        print_changes(update(args.root, n_jobs=args.n_jobs))
+    elif args.mode=='verify':
+        changes = verify(args.root, full=args.full, n_jobs=args.n_jobs)
+        print_changes(changes)
+        sys.exit(1 if any(changes.values()) else 0)
+    else:
+        if args.old is None:
+            parser.error('diff needs the checksums of the last release')
+        with open(args.old, 'r') as f:
+            old = json.load(f)['files']
+        print(format_changes(diff(old, load(args.root)), args.version))
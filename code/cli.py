@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 08:14:52 2026
+
+single entry point of the conversion. Only the module of the chosen
+subcommand is imported, and the modules only import mne, mne_bids and
+pandas where they are needed, so `--help` takes well under a second.
+The options of each subcommand are parsed by its module, see
+`python code/cli.py <subcommand> --help`.
+
+    python code/cli.py convert --raw-folder ../highspeed-MEG-raw/ --subjects 01 02
+    python code/cli.py emptyroom
+    python code/cli.py events ../highspeed-MEG-raw/data-logs/MFR-01/01_main_*.csv --out-dir events/
+    python code/cli.py recon --project-dir ../Fast-Replay-MEG/ --subjects 01
+
+@author: simon.kern
+"""
+import sys
+import argparse
+import importlib
+
+# subcommand -> (module with a main(argv), arguments put in front, help)
+commands = {'convert': ('convert_to_bids', [], 'convert MEG, behaviour and empty rooms to BIDS'),
+            'emptyroom': ('convert_to_bids', ['--steps', 'emptyroom'],
+                          'only convert the empty rooms'),
+            'events': ('events_conversion', [], 'convert psychopy runs to BIDS events'),
+            'recon': ('run_recon_all', [], 'run recon-all for the anatomy of all subjects')}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='convert the Fast-Replay MEG dataset to BIDS')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name, (_, _, help) in commands.items():
+        subparsers.add_parser(name, help=help, add_help=False)
+    args, argv_command = parser.parse_known_args(argv)
+
+    module, args_command, _ = commands[args.command]
+    return importlib.import_module(module).main(args_command + argv_command)
+
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 15:20:05 2026
+
+convert the anatomical T1 of all subjects to BIDS, replacing the serial
+heudiconv docker loop of `make anat`.
+
+The DICOM headers of all files are indexed once (headers only, cached and
+only re-read for files that changed), the heuristic in
+heudiconv_heuristic.py selects the series per subject and the selected
+series are converted with dcm2niix, several subjects at the same time.
+Subjects whose T1w_orig is newer than their DICOMs are skipped.
+
+@author: simon.kern
+"""
+import os
+import glob
+import json
+import asyncio
+import argparse
+import tempfile
+from collections import namedtuple
+import pydicom
+from joblib import Parallel, delayed
+import heudiconv_heuristic
+from supervisor import Progress, get_logger, run_command
+from manifest import file_lock
+
+# the fields of heudiconv's seqinfo that our heuristic uses
+SeqInfo = namedtuple('SeqInfo', ['series_id', 'series_description', 'protocol_name',
+                                 'series_number', 'files'])
+
+index_file = os.path.expanduser('~/.cache/fastreplay-MEG-bids/dicom_index.json')
+log_dir = os.path.expanduser('~/.cache/fastreplay-MEG-bids/logs/')
+header_tags = ['SeriesInstanceUID', 'SeriesNumber', 'SeriesDescription', 'ProtocolName']
+
+
+def read_header(file):
+    """read the header fields we need, without the pixel data"""
+    dcm = pydicom.dcmread(file, stop_before_pixels=True, specific_tags=header_tags)
+    return {tag: str(dcm.get(tag, '')) for tag in header_tags}
+
+
+def build_index(files, index_file=index_file, n_jobs=16):
+    """index the headers of all DICOM files, re-using the cached headers
+    of files whose size and mtime didn't change. Several conversions (e.g.
+    of different subjects) can share the cache"""
+    index = {}
+    if os.path.isfile(index_file):
+        with open(index_file, 'r') as f:
+            index = json.load(f)
+
+    stats = {file: os.stat(file) for file in files}
+    outdated = [file for file, stat in stats.items()
+                if index.get(file, {}).get('stat')!=[stat.st_size, stat.st_mtime]]
+    headers = Parallel(n_jobs, backend='threading')(delayed(read_header)(f) for f in outdated)
+    for file, header in zip(outdated, headers):
+        index[file] = {'stat': [stats[file].st_size, stats[file].st_mtime], 'header': header}
+
+    if outdated:
+        os.makedirs(os.path.dirname(index_file), exist_ok=True)
+        with file_lock(index_file):
+            cached = {}
+            if os.path.isfile(index_file):
+                with open(index_file, 'r') as f:
+                    cached = json.load(f)
+            with open(index_file + '.tmp', 'w') as f:
+                json.dump(cached | {file: index[file] for file in outdated}, f)
+            os.replace(index_file + '.tmp', index_file)
+    return {file: index[file] for file in files}
+
+
+def get_seqinfo(index, files):
+    """group the files of one subject into series"""
+    series = {}
+    for file in sorted(files):
+        header = index[file]['header']
+        series.setdefault(header['SeriesInstanceUID'], []).append(file)
+    seqinfo = []
+    for files_series in series.values():
+        header = index[files_series[0]]['header']
+        series_id = f"{header['SeriesNumber']}-{header['ProtocolName']}"
+        seqinfo += [SeqInfo(series_id, header['SeriesDescription'], header['ProtocolName'],
+                            header['SeriesNumber'], files_series)]
+    return seqinfo
+
+
+async def convert_subject(subj, files, bids_root, index, dcm2niix, semaphore):
+    """select the T1 series with the heuristic and convert it with dcm2niix"""
+    seqinfo = get_seqinfo(index, files)
+    info = heudiconv_heuristic.infotodict(seqinfo)
+    async with semaphore:
+        for (template, _, _), items in info.items():
+            if not items:
+                return f'sub-{subj}: no matching series found'
+            if len(items)>1:
+                return f'sub-{subj}: several matching series {[i["item"] for i in items]}'
+            seq = [s for s in seqinfo if s.series_id==items[0]['item']][0]
+            out_file = os.path.join(bids_root, template.format(subject=subj))
+
+            # skip if the output is newer than all DICOMs of the series. The
+            # _orig is deleted by defacing.sh once the defaced T1w is written
+            newest_dicom = max(os.path.getmtime(f) for f in seq.files)
+            for file in [out_file, out_file.replace('_orig', '')]:
+                if os.path.isfile(file + '.nii.gz') and os.path.getmtime(file + '.nii.gz') > newest_dicom:
+                    return f'sub-{subj}: up to date'
+
+            os.makedirs(os.path.dirname(out_file), exist_ok=True)
+            os.makedirs(log_dir, exist_ok=True)
+            logger = get_logger(f'anat-{subj}', f'{log_dir}/anat-sub-{subj}.log')
+            # dcm2niix converts all series in a folder, so only link the selected one
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                for file in seq.files:
+                    os.symlink(os.path.abspath(file), f'{tmp_dir}/{os.path.basename(file)}')
+                cmd = f'{dcm2niix} -z y -b y -f {os.path.basename(out_file)} ' \
+                      f'-o {os.path.dirname(out_file)} {tmp_dir}'
+                returncode = await run_command(cmd, logger, timeout=30*60)
+            if returncode!=0:
+                return f'sub-{subj}: dcm2niix exited with {returncode}'
+    return f'sub-{subj}: converted'
+
+
+async def convert_all(subjects, bids_root, index, dcm2niix, n_jobs):
+    semaphore = asyncio.Semaphore(n_jobs)
+    progress = Progress(len(subjects), desc='converting anatomy')
+
+    async def convert(subj, files):
+        try:
+            return await convert_subject(subj, files, bids_root, index, dcm2niix, semaphore)
+        finally:
+            progress.finish(subj)
+
+    results = await asyncio.gather(*[convert(subj, files) for subj, files in subjects.items()])
+    progress.close()
+    return results
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='convert the T1 images of all subjects to BIDS')
+    parser.add_argument('--dicom-root', default='../Fast-Replay-MEG/data-MRI/',
+                        help='folder with one MFRXX folder of DICOMs per subject')
+    parser.add_argument('--bids-root', default='.')
+    parser.add_argument('--subjects', nargs='*', default=[f'{i:02d}' for i in range(1, 31)])
+    parser.add_argument('--dcm2niix', default='dcm2niix', help='path to the dcm2niix executable')
+    parser.add_argument('--n-jobs', type=int, default=8)
+    args = parser.parse_args()
+
+    subjects = {subj: [os.path.abspath(f) for f in glob.glob(f'{args.dicom_root}/MFR{subj}/*IMA')]
+                for subj in args.subjects}
+    missing = [subj for subj, files in subjects.items() if not files]
+    if missing:
+        print(f'no DICOMs found for {missing=}')
+    subjects = {subj: files for subj, files in subjects.items() if files}
+
+    index = build_index([file for files in subjects.values() for file in files])
+    results = asyncio.run(convert_all(subjects, args.bids_root, index, args.dcm2niix, args.n_jobs))
+    print('\n'.join(results))
@@ -1,158 +1,525 @@
-#!/usr/bin/env python3
-# -*- coding: utf-8 -*-
-"""
-Created on Mon Oct 21 09:37:28 2024
-
-@author: simon.kern
-"""
-import os
-import mne
-from pathlib import Path
-from tqdm import tqdm
-import mne_bids
-import events_conversion
-import shutil
-from mne_bids import BIDSPath, write_raw_bids, write_anat
-import misc
-import stimer
-from stimer import ContextProfiler
-# change this to the raw file folder
-raw_files_folder = '/zi/flstorage/group_klips/data/data/Simon/highspeed/highspeed-MEG-raw/'
-
-bids_root_path = os.path.abspath(os.path.dirname(vars().get('__file__', '')) + '/../')
-# bids_root = BIDSPath(root=bids_root_path)
-
-
-subjects = [x for x in os.listdir(f'{raw_files_folder}/data-MEG/') if x.startswith('mfr')]
-print(f'{len(subjects)=} subjects found')
-
-#%% convert to BIDS
-reports = []
-for subj in tqdm(sorted(subjects), desc='processing subjects'):
-# with ContextProfiler():
-    subj_id = subj.split('_', 1)[-1]
-    assert len(subj_id)==2
-
-    subj_folder = f'{raw_files_folder}/data-MEG/{subj}/'
-    files_subj = [x for x in os.listdir(subj_folder) if x.endswith('fif')]
-
-    ### 1) first convert the two resting states
-    # bids_path = BIDSPath(subject=subj_id, root=bids_root)
-    for rs in [1, 2]:
-        fif_file = [x for x in files_subj if f'_rs{rs}_' in x]
-        assert len(fif_file)==1
-        raw = mne.io.read_raw_fif(f'{subj_folder}/{fif_file[0]}')
-        raw, report = misc.check_and_fix_channels(raw)
-        events = mne.find_events(raw, min_duration=3/raw.info['sfreq'])
-        event_id = {'resting state start': 1, 'resting state stop': 2}
-        bids_task = BIDSPath(subject=subj_id,
-                             datatype='meg',
-                             task=f'rest{rs}',
-                             root=bids_root_path)
-
-        write_raw_bids(raw=raw,
-                       allow_preload = True,
-                       bids_path=bids_task,
-                       events=events,
-                       event_id=event_id,
-                       format='FIF',
-                       # empty_room=raw_er,
-                       overwrite=True,
-                       verbose=True
-                       )
-        reports += [report]
-
-    ### 2) next convert the main data
-    fif_file = [x for x in files_subj if f'_main_' in x and x.endswith('.fif') and 'tsss' in x and not '-1.' in x]
-    assert len(fif_file)==1
-    raw = mne.io.read_raw_fif(f'{subj_folder}/{fif_file[0]}')
-    raw, report = misc.check_and_fix_channels(raw)
-    reports += [report]
-
-    events = mne.find_events(raw, min_duration=3/raw.info['sfreq'])
-    stimuli = ['Face', 'House', 'Cat', 'Shoe', 'Chair']
-    event_id = ({'Break start': 91,
-                'Break stop': 92,
-                'Sequence Buffer start': 61,
-                'Sequence Buffer stop': 62,
-                'sequence sound error': 70,
-                'sequencesound coin': 71,
-                'localizer sound error': 30,
-                'localizer sound coin': 31,
-                'fixation pre 1': 81,
-                'fixation pre 2': 82,
-                } | {f'localizer {stim} onset':i for i, stim in enumerate(stimuli, 1)}
-                  | {f'localizer {stim} distractor onset':i+100 for i, stim in enumerate(stimuli, 1)}
-                  | {f'cue {stim}':i+10 for i, stim in enumerate(stimuli, 1)}
-                  | {f'sequence {stim} onset':i+20 for i, stim in enumerate(stimuli, 1)}
-                )
-
-    bids_task_main= BIDSPath(subject=subj_id,
-                             datatype='meg',
-                             task=f'main',
-                             root=bids_root_path)
-    write_raw_bids(raw=raw,
-                    bids_path=bids_task_main,
-                    allow_preload = True,
-                    events=events,
-                    event_id=event_id,
-                    format='FIF',
-                    # empty_room=raw_er,
-                    overwrite=True,
-                    verbose=True
-                   )
-
-
-    ### 3) behavioural data
-    # basically sourdedata is a fractal BIDS folder
-    bids_task_source = BIDSPath(subject=subj_id,
-                         datatype='beh',
-                         task=f'main',
-                         root=bids_root_path + '/sourcedata/')
-    bids_task_source.mkdir()
-
-    # filter CSV file
-    subj_folder = f'{raw_files_folder}/data-logs/{subj.replace("_", "-").upper()}/'
-    files_subj = [x for x in os.listdir(subj_folder) if x.endswith('csv') ]
-    files_subj = [x for x in files_subj if (('main_' in x) & x.startswith(f'{int(subj_id):02d}'))]
-    files_subj = [f'{subj_folder}/{x}' for x in files_subj]
-    assert len(files_subj)==1
-    csv_file = files_subj[0]
-    log_file = files_subj[0][:-3] + 'log'
-    shutil.copy(log_file, str(bids_task_source.fpath) + '.log')
-
-    bids_task_main.update(datatype='beh', suffix='beh')
-    bids_task_main.mkdir()
-    df_subj = events_conversion.convert_psychopy_to_bids(csv_file)
-    df_subj['subject'] = f'sub-{subj_id}'
-    df_subj['session'] = 1
-
-    df_subj.to_csv(str(bids_task_main.fpath) + '.tsv', sep='\t', index=False,
-                   na_rep='NaN')
-
-    # asd
-    # ### 4) MRI data
-    #### MRI DATA IS ALREADY CONVERTED VIA HEUDICONV
-    # t1w_path = BIDSPath(subject=subj_id,
-    #                     datatype='anat',
-    #                     # task=f'T1w',
-    #                     root=bids_root_path)
-
-    # t1w_bids_path = write_anat(
-    #     image='/data/fastreplay/Fast-Replay-MEG-bids/sub-01/anat/sub-02_T1w.nii.gz',  # path to the MRI scan
-    #     bids_path=t1w_path,
-    #     landmarks=None,
-    #     deface=False,
-    #     overwrite=True,
-    #     verbose=True,  # this will print out the sidecar file
-    # )
-
-#%%  copy emptyroom data
-empty_fifs = os.listdir(raw_files_folder + '/data-empty-room/')
-for fif_file in tqdm(empty_fifs, desc='writing empty rooms'):
-    raw = mne.io.read_raw(raw_files_folder + '/data-empty-room/' +  fif_file, verbose='ERROR')
-    er_date = fif_file.split('_')[1]
-    er_bids_path = BIDSPath(
-        subject="emptyroom", session=er_date, task="noise", root=bids_root_path
-    )
-    write_raw_bids(raw, er_bids_path, overwrite=True)
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 21 09:37:28 2024
+
+@author: simon.kern
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import shutil
+import traceback
+from contextlib import closing
+import tracemalloc
+from manifest import Manifest, code_version, hash_file
+from raw_index import RawIndex
+import instrument
+import pipeline
+# mne, mne_bids, pandas and joblib take seconds to import, so they are only
+# imported in the functions that need them and `--help` returns right away
+# change this to the raw file folder
+raw_files_folder = '/zi/flstorage/group_klips/data/data/Simon/highspeed/highspeed-MEG-raw/'
+
+bids_root_path = os.path.abspath(os.path.dirname(vars().get('__file__', '')) + '/../')
+# bids_root = BIDSPath(root=bids_root_path)
+
+# number of subjects that are converted in parallel. Each job holds up to
+# a full main-task recording (and the resting state that is still being
+# written) in memory, so this is further limited by RAM
+n_jobs = 16
+mem_per_job = 12  # GB, approximate peak memory of converting one subject
+n_jobs_er = 4  # empty rooms are only copied, so this is limited by network IO
+steps = ['emptyroom', 'meg', 'beh', 'dataset']
+
+stimuli = ['Face', 'House', 'Cat', 'Shoe', 'Chair']
+event_id_rest = {'resting state start': 1, 'resting state stop': 2}
+event_id_main = ({'Break start': 91,
+                  'Break stop': 92,
+                  'Sequence Buffer start': 61,
+                  'Sequence Buffer stop': 62,
+                  'sequence sound error': 70,
+                  'sequencesound coin': 71,
+                  'localizer sound error': 30,
+                  'localizer sound coin': 31,
+                  'fixation pre 1': 81,
+                  'fixation pre 2': 82,
+                  } | {f'localizer {stim} onset':i for i, stim in enumerate(stimuli, 1)}
+                    | {f'localizer {stim} distractor onset':i+100 for i, stim in enumerate(stimuli, 1)}
+                    | {f'cue {stim}':i+10 for i, stim in enumerate(stimuli, 1)}
+                    | {f'sequence {stim} onset':i+20 for i, stim in enumerate(stimuli, 1)}
+                  )
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='convert raw MEG and behavioural data to BIDS')
+    parser.add_argument('--force', action='store_true',
+                        help='re-convert everything, even outputs that are up to date')
+    parser.add_argument('--scratch', default=None,
+                        help='fast local folder in which the outputs are built before '
+                             'they are published to the BIDS root, default: $TMPDIR')
+    parser.add_argument('--raw-folder', default=raw_files_folder,
+                        help='folder with data-MEG, data-logs and data-empty-room')
+    parser.add_argument('--bids-root', default=bids_root_path,
+                        help='BIDS root to write to, default: the parent of code/')
+    parser.add_argument('--report-dir', default=None,
+                        help='folder of the run reports (time and memory of each step), '
+                             'default: BIDS_ROOT/.conversion_reports/')
+    parser.add_argument('--profile', action='store_true',
+                        help='also write a cProfile of each subject into the report folder')
+    parser.add_argument('--trace-malloc', action='store_true',
+                        help='record the peak of the python allocations of each step, '
+                             'this slows down the conversion')
+    parser.add_argument('--memmap', action='store_true',
+                        help='load recordings that need fixing into memory-mapped files on '
+                             'the scratch folder instead of RAM')
+    parser.add_argument('--n-jobs', type=int, default=n_jobs,
+                        help='maximum number of subjects that are converted in parallel')
+    parser.add_argument('--mem-per-job', type=float, default=mem_per_job,
+                        help='approximate peak memory of converting one subject in GB, '
+                             'limits the parallel jobs to the available memory')
+    parser.add_argument('--subjects', nargs='+', default=None,
+                        help='only convert these subjects, e.g. 01 02, default: all')
+    parser.add_argument('--steps', nargs='+', default=steps, choices=steps,
+                        help='only run these steps, several conversions of different steps or '
+                             'subjects can run at the same time, see run_pipeline.py')
+    return parser
+
+
+class Conversion():
+    """settings and state of one run of the conversion, which are passed
+    to the worker processes along with each subject.
+
+    Parameters
+    ----------
+    args : the parsed arguments, see `get_parser`
+    """
+    def __init__(self, args):
+        import mne_bids
+        import misc
+        import alignment
+        import events_conversion
+        from staging import Staging
+        self.args = args
+        self.bids_root = os.path.abspath(args.bids_root)
+        self.report_dir = args.report_dir or f'{self.bids_root}/.conversion_reports/'
+        # outputs are only re-converted if their sources or the code changed
+        self.manifest = Manifest(f'{self.bids_root}/.conversion_manifest.json')
+        # outputs are written to local scratch and moved to the BIDS root per subject
+        self.staging = Staging(self.bids_root, args.scratch)
+        # missing channels are added from the template, so its content is
+        # part of the version of the MEG outputs, like all code of misc
+        template = hash_file(misc.template_file) if os.path.isfile(misc.template_file) else None
+        self.version_rest = code_version(misc, template, event_id_rest, mne_bids.__version__)
+        self.version_main = code_version(misc, template, event_id_main, mne_bids.__version__)
+        # the triggers for the alignment are read with misc.find_events
+        self.version_beh = code_version(events_conversion, alignment, misc)
+        self.version_er = code_version(mne_bids.__version__)
+        # measurement dates of the published empty rooms, see `nearest_emptyroom`
+        self.er_dates = {}
+
+
+#%% convert to BIDS
+def get_n_jobs(n_jobs=n_jobs, mem_per_job=mem_per_job):
+    """number of parallel jobs that fit into CPU count and available memory"""
+    import psutil
+    mem_available = psutil.virtual_memory().available / 1024**3
+    return max(1, min(n_jobs, os.cpu_count(), int(mem_available // mem_per_job)))
+
+
+#%% empty rooms first, the MEG recordings of the subjects refer to them
+def get_emptyroom_path(er_date, root):
+    from mne_bids import BIDSPath
+    return BIDSPath(subject='emptyroom', session=er_date, task='noise',
+                    datatype='meg', suffix='meg', extension='.fif', root=root)
+
+
+def convert_emptyroom(conv, er_date, sources):
+    """write one empty-room session into its own staging folder"""
+    import mne
+    from mne_bids import BIDSPath, write_raw_bids
+    stage_root = conv.staging.new_root(f'sub-emptyroom_ses-{er_date}')
+    key = f'sub-emptyroom_ses-{er_date}_task-noise_meg'
+    try:
+        er_bids_path = BIDSPath(subject="emptyroom", session=er_date, task="noise",
+                                root=conv.bids_root)
+        with instrument.context(subject='emptyroom', session=er_date):
+            with instrument.stage('read_raw'):
+                raw = mne.io.read_raw(sources[0], verbose='ERROR')
+            with instrument.stage('write_raw_bids'):
+                write_raw_bids(raw, conv.staging.staged(er_bids_path, stage_root), overwrite=True,
+                               verbose='ERROR')
+        return {'key': key, 'stage_root': stage_root, 'stages': instrument.collect(),
+                'entry': conv.manifest.make_entry(key, sources, conv.version_er), 'error': None}
+    except Exception:
+        conv.staging.discard(stage_root)
+        return {'key': key, 'stage_root': None, 'stages': instrument.collect(),
+                'entry': None, 'error': traceback.format_exc()}
+
+
+def get_emptyroom_sources(raw_index):
+    """the source files of each empty-room session, by date.
+
+    several files of one day would be written to the same session, only the
+    first one is used. Splits (name-1.fif) are read along with their first file"""
+    emptyrooms = {}
+    for er_file in raw_index.emptyrooms():
+        if er_file.split==0:
+            emptyrooms.setdefault(er_file.date, []).append(er_file)
+    sources_er = {}
+    for er_date, er_files in sorted(emptyrooms.items()):
+        if len(er_files)>1:
+            names = [os.path.basename(f.path) for f in er_files]
+            print(f'WARNING: several empty rooms for {er_date}: {names}, using the first')
+        splits = [f for f in raw_index.emptyrooms() if f.path==f'{er_files[0].path[:-4]}-{f.split}.fif']
+        sources_er[er_date] = [raw_index.path(f) for f in [er_files[0]] + sorted(splits, key=lambda f: f.split)]
+    return sources_er
+
+
+def convert_emptyrooms(conv, sources_er):
+    """convert the empty rooms that are out of date in parallel and publish
+    them, returns the time and memory of each step and the errors"""
+    from tqdm import tqdm
+    from joblib import Parallel, delayed
+    args, manifest = conv.args, conv.manifest
+    todo_er = {er_date: sources for er_date, sources in sources_er.items()
+               if 'emptyroom' in args.steps and (args.force or not manifest.is_up_to_date(
+                       f'sub-emptyroom_ses-{er_date}_task-noise_meg', sources,
+                       [str(get_emptyroom_path(er_date, conv.bids_root).fpath)], conv.version_er))}
+    print(f'converting {len(todo_er)}/{len(sources_er)} empty rooms')
+    results_er = Parallel(n_jobs=n_jobs_er, return_as='generator_unordered')(
+        delayed(convert_emptyroom)(conv, er_date, sources) for er_date, sources in todo_er.items())
+    records = []  # of instrument.stage, of all processes
+    errors = {}
+    for res in tqdm(results_er, total=len(todo_er), desc='writing empty rooms'):
+        records += res['stages']
+        if res['error']:
+            print('#'*40, res['key'])
+            print(res['error'])
+            errors[res['key']] = res['error']
+            continue
+        with instrument.stage('publish', subject='emptyroom'):
+            conv.staging.publish(res['stage_root'])
+        manifest.update(res['key'], res['entry'])
+        manifest.save()
+    return records, errors
+
+
+def nearest_emptyroom(fif_file, er_dates):
+    """session of the empty room that was recorded closest in time"""
+    import misc
+    meas_date = misc.get_meas_date(fif_file)
+    if meas_date is None or not er_dates:
+        return None
+    return min(er_dates, key=lambda er_date: abs(er_dates[er_date] - meas_date))
+
+
+def link_emptyroom(er_date, stage_root, bids_root):
+    """BIDSPath of a published empty room for write_raw_bids(empty_room=).
+    mne_bids only accepts an empty room in the same root, so it is linked
+    into the staging folder, the link is removed before publishing"""
+    if er_date is None:
+        return None
+    er_path = get_emptyroom_path(er_date, root=stage_root)
+    if not os.path.lexists(er_path.fpath):
+        er_path.mkdir()
+        os.symlink(get_emptyroom_path(er_date, bids_root).fpath, er_path.fpath)
+    return er_path
+
+
+#%% convert the subjects
+def convert_subject(conv, subj_id, files, stage_root):
+    """convert resting states, main task and behaviour of one subject
+    and return the reports of check_and_fix_channels and the manifest
+    entries of everything that was converted.
+
+    files are the sources of each step, see RawIndex.subject_files, steps
+    without sources are skipped. Everything is written to stage_root"""
+    import mne
+    import numpy as np
+    import misc
+    import alignment
+    import events_conversion
+    from mne_bids import BIDSPath, write_raw_bids
+    args, manifest, staging = conv.args, conv.manifest, conv.staging
+    bids_root_path = conv.bids_root
+    reports = []
+    entries = {}
+    assert len(subj_id)==2
+
+    ### 1) resting states and 2) main task
+    # the MEG recordings are read, fixed and written in a pipeline: the next
+    # recording is read while the current one is fixed, which is written in
+    # the background while the next one is fixed. At most two recordings
+    # are held in memory at once, the one being fixed and the one being written
+    todo = []
+    tasks = [('rest1', event_id_rest, conv.version_rest),
+             ('rest2', event_id_rest, conv.version_rest),
+             ('main', event_id_main, conv.version_main)]
+    for task, event_id, version_task in tasks if 'meg' in args.steps else []:
+        bids_task = BIDSPath(subject=subj_id,
+                             datatype='meg',
+                             task=task,
+                             root=bids_root_path)
+        key = f'sub-{subj_id}_task-{task}_meg'
+        # the first file and its splits name-1.fif etc, which mne reads along
+        sources = files[task]
+        outputs = [f'{bids_task.directory}/{bids_task.basename}*_meg.fif']
+        if sources is None:
+            print(f'{key} has no sources, skipping')
+            continue
+        er_date = nearest_emptyroom(sources[0], conv.er_dates)
+        version = code_version(version_task, er_date)
+        if not args.force and manifest.is_up_to_date(key, sources, outputs, version):
+            print(f'{key} is up to date')
+            continue
+        todo += [{'task': task, 'key': key, 'sources': sources, 'bids_path': bids_task,
+                  'event_id': event_id, 'er_date': er_date, 'version': version}]
+
+    def read_recording(job):
+        with instrument.stage('read_raw', task=job['task']):
+            for fif_file in job['sources']:
+                misc.prefetch_file(fif_file)
+            raw = mne.io.read_raw_fif(job['sources'][0])
+        with instrument.stage('find_events', task=job['task']):
+            events = misc.find_events(raw, min_duration=3/raw.info['sfreq'])
+        return job, raw, events
+
+    def write_recording(job, raw, events):
+        with instrument.stage('write_raw_bids', task=job['task']):
+            write_raw_bids(raw=raw,
+                           allow_preload=bool(raw.preload),  # unchanged files are written without loading
+                           bids_path=staging.staged(job['bids_path'], stage_root),
+                           events=events,
+                           event_id=job['event_id'],
+                           format='FIF',
+                           empty_room=link_emptyroom(job['er_date'], stage_root, bids_root_path),
+                           overwrite=True,
+                           verbose=True
+                           )
+        entries[job['key']] = manifest.make_entry(job['key'], job['sources'], job['version'])
+
+    with closing(pipeline.prefetch(read_recording, todo)) as recordings, \
+         pipeline.Writer(max_pending=1) as writer:
+        for job, raw, events in recordings:
+            # with --memmap, recordings that need fixing are loaded to the scratch disk
+            preload = f'{stage_root}/.memmap/{job["task"]}.dat' if args.memmap else True
+            os.makedirs(f'{stage_root}/.memmap/', exist_ok=True)
+            with instrument.stage('check_and_fix_channels', task=job['task']):
+                raw, report = misc.check_and_fix_channels(raw, preload=preload)
+            reports += [report]
+            writer.submit(write_recording, job, raw, events)
+            del raw  # only the writer holds it now
+
+    bids_task_main = BIDSPath(subject=subj_id,
+                              datatype='meg',
+                              task='main',
+                              root=bids_root_path)
+
+    ### 3) behavioural data
+    # basically sourdedata is a fractal BIDS folder
+    bids_task_source = BIDSPath(subject=subj_id,
+                         datatype='beh',
+                         task=f'main',
+                         root=bids_root_path + '/sourcedata/')
+
+    if files['beh'] is None or 'beh' not in args.steps:
+        return reports, entries
+    csv_file, log_file = files['beh']
+    bids_task_main.update(datatype='beh', suffix='beh')
+
+    key = f'sub-{subj_id}_task-main_beh'
+    # the MEG recording is needed to put the behaviour on the MEG clock
+    sources = [csv_file, log_file] + (files['main'] or [])
+    outputs = [str(bids_task_source.fpath) + '.log', str(bids_task_main.fpath) + '.tsv',
+               str(bids_task_main.fpath) + '.json']
+    if not args.force and manifest.is_up_to_date(key, sources, outputs, conv.version_beh):
+        print(f'{key} is up to date')
+        return reports, entries
+
+    bids_task_source = staging.staged(bids_task_source, stage_root)
+    bids_task_source.mkdir()
+    shutil.copy(log_file, str(bids_task_source.fpath) + '.log')
+
+    bids_task_main = staging.staged(bids_task_main, stage_root)
+    bids_task_main.mkdir()
+    with instrument.stage('events_conversion', task='beh'):
+        df_subj = events_conversion.convert_psychopy_to_bids(csv_file)
+    df_subj['subject'] = f'sub-{subj_id}'
+    df_subj['session'] = 1
+
+    # match the stimulus onsets to the MEG triggers and fit the clock offset
+    # and drift, the events are read from the cache of the MEG conversion
+    # without a main recording the events are written without onset_meg
+    trigger_times, trigger_values = np.array([]), np.array([], dtype=int)
+    with instrument.stage('alignment', task='beh'):
+        if files['main'] is not None:
+            raw = mne.io.read_raw_fif(files['main'][0], verbose='ERROR')
+            events = misc.find_events(raw, min_duration=3/raw.info['sfreq'])
+            trigger_times = (events[:, 0] - raw.first_samp) / raw.info['sfreq']
+            trigger_values = events[:, 2]
+        df_subj, stats = alignment.align_to_meg(df_subj, trigger_times, trigger_values)
+    if not stats['aligned']:
+        print(f'WARNING: {key} could not be aligned to the MEG triggers, {stats}')
+
+    with instrument.stage('write_tsv', task='beh'):
+        df_subj.to_csv(str(bids_task_main.fpath) + '.tsv', sep='\t', index=False,
+                       na_rep='NaN')
+    sidecar = {'onset_meg': {'Description': 'onset on the clock of the MEG recording '
+                                            '(task-main), fitted to the triggers',
+                             'Units': 's'},
+               'trigger_residual': {'Description': 'time of the matched MEG trigger '
+                                                   'minus onset_meg',
+                                    'Units': 's'},
+               'MEGAlignment': stats}
+    with open(str(bids_task_main.fpath) + '.json', 'w') as f:
+        json.dump(sidecar, f, indent=4)
+    entries[key] = manifest.make_entry(key, sources, conv.version_beh)
+    return reports, entries
+
+    # asd
+    # ### 4) MRI data
+    #### MRI DATA IS ALREADY CONVERTED VIA HEUDICONV
+    # t1w_path = BIDSPath(subject=subj_id,
+    #                     datatype='anat',
+    #                     # task=f'T1w',
+    #                     root=bids_root_path)
+
+    # t1w_bids_path = write_anat(
+    #     image='/data/fastreplay/Fast-Replay-MEG-bids/sub-01/anat/sub-02_T1w.nii.gz',  # path to the MRI scan
+    #     bids_path=t1w_path,
+    #     landmarks=None,
+    #     deface=False,
+    #     overwrite=True,
+    #     verbose=True,  # this will print out the sidecar file
+    # )
+
+
+def convert_subject_safe(conv, subj, files):
+    """run convert_subject, return the error instead of raising it so that
+    one failing subject doesn't stop the others. A failed subject is not
+    published at all. The time and memory of each step are returned as well"""
+    args = conv.args
+    stage_root = conv.staging.new_root(f'sub-{subj}')
+    prof_file = f'{conv.report_dir}/profiles/sub-{subj}.prof' if args.profile else None
+    if args.trace_malloc and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    try:
+        with instrument.context(subject=f'sub-{subj}'), instrument.profile(prof_file), \
+             instrument.stage('convert_subject'):
+            reports, entries = convert_subject(conv, subj, files, stage_root)
+        shutil.rmtree(f'{stage_root}/sub-emptyroom', ignore_errors=True)
+        shutil.rmtree(f'{stage_root}/.memmap', ignore_errors=True)
+        return {'subject': subj, 'reports': reports, 'entries': entries,
+                'stages': instrument.collect(), 'stage_root': stage_root, 'error': None}
+    except Exception:
+        conv.staging.discard(stage_root)
+        return {'subject': subj, 'reports': [], 'entries': {},
+                'stages': instrument.collect(), 'stage_root': None,
+                'error': traceback.format_exc()}
+
+
+def convert_subjects(conv, files_subjects, n_jobs_subj):
+    """convert the subjects in parallel, each is published as soon as it is
+    done. Returns the results of `convert_subject_safe`, sorted by subject"""
+    from tqdm import tqdm
+    from joblib import Parallel, delayed
+    results = Parallel(n_jobs=n_jobs_subj, return_as='generator_unordered')(
+        delayed(convert_subject_safe)(conv, subj, files) for subj, files in files_subjects.items())
+    results_subj = []
+    for res in tqdm(results, total=len(files_subjects), desc='processing subjects'):
+        # only the main process publishes and writes the manifest, after each
+        # finished subject
+        if res['stage_root']:
+            with instrument.stage('publish', subject=f'sub-{res["subject"]}'):
+                conv.staging.publish(res['stage_root'])
+        for key, entry in res['entries'].items():
+            conv.manifest.update(key, entry)
+        conv.manifest.save()
+        results_subj += [res]
+    # participants.tsv is only written once, for all subjects
+    conv.staging.finish()
+    return sorted(results_subj, key=lambda x: x['subject'])
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    import pandas as pd
+    import misc
+    conv = Conversion(args)
+    # time and memory of each step, written at the end of the run
+    started = time.strftime('%Y-%m-%d %H:%M:%S')
+    report_file = f'{conv.report_dir}/run-{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}.json'
+
+    with instrument.stage('index'):
+        raw_index = RawIndex(args.raw_folder)
+    subjects = raw_index.subjects()
+    print(f'{len(subjects)=} subjects found')
+    if args.subjects is not None:
+        subjects = [subj for subj in subjects if subj in args.subjects]
+    if not {'meg', 'beh'} & set(args.steps):
+        subjects = []
+
+    # report missing or ambiguous input files before anything is converted,
+    # the affected steps are skipped for that subject
+    files_subjects = {}
+    for subj_id in subjects:
+        files_subjects[subj_id], problems = raw_index.subject_files(subj_id)
+        for problem in problems:
+            print(f'WARNING: {problem}, skipping')
+
+    #%% empty rooms first, the MEG recordings of the subjects refer to them
+    sources_er = get_emptyroom_sources(raw_index)
+    records, errors = convert_emptyrooms(conv, sources_er)
+
+    # measurement dates of the published empty rooms, to find the closest one
+    er_dates = {er_date: misc.get_meas_date(sources[0]) for er_date, sources in sources_er.items()
+                if get_emptyroom_path(er_date, conv.bids_root).fpath.exists()}
+    conv.er_dates = {er_date: meas_date for er_date, meas_date in er_dates.items() if meas_date}
+
+    #%% convert the subjects
+    n_jobs_subj = get_n_jobs(args.n_jobs, args.mem_per_job)
+    print(f'converting with {n_jobs_subj=}')
+    results = convert_subjects(conv, files_subjects, n_jobs_subj)
+    reports = [report for res in results for report in res['reports']]
+
+    for res in results:
+        records += res['stages']
+        if res['error']:
+            print('#'*40, res['subject'])
+            print(res['error'])
+            errors[f'sub-{res["subject"]}'] = res['error']
+    print(f'{sum(bool(res["error"]) for res in results)}/{len(results)} subjects failed')
+
+    #%% behaviour of all subjects as one parquet dataset for group analyses
+    if 'dataset' in args.steps:
+        import beh_dataset  # pyarrow is only needed here
+        with instrument.stage('beh_dataset'):
+            updated = beh_dataset.update(conv.bids_root)
+        print(f'updated behavioural dataset for {updated}')
+
+    #%% checksums of all files, only new and changed files are hashed
+    if 'dataset' in args.steps:
+        import checksums
+        with instrument.stage('checksums'):
+            changes = checksums.update(conv.bids_root)
+        print('checksums: ' + ', '.join(f'{len(files)} {kind}' for kind, files in changes.items()))
+
+    #%% run report with the time and memory of each step and the channel reports
+    records += instrument.collect()
+    instrument.write_report(report_file, records, started=started,
+                            finished=time.strftime('%Y-%m-%d %H:%M:%S'),
+                            args=vars(args), n_jobs=n_jobs_subj,
+                            channel_reports=reports, errors=errors)
+    if records:
+        df_stages = pd.DataFrame(records)
+        print(df_stages.groupby('stage')['wall_s'].agg(['count', 'sum', 'max']).round(1))
+    print(f'run report written to {report_file}')
+    # e.g. run_pipeline.py only records conversions that succeeded
+    return 1 if errors else 0
+
+
+if __name__=='__main__':
+    sys.exit(main())
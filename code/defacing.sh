@@ -1,11 +1,13 @@
 #!/bin/bash
 # this script is called via "make defacing" in the parent dir.
+# an optional second argument restricts it to one subject, e.g. sub-01
 PATH_PROJECT=$1
+SUBJECT=${2:-*}
 PYDEFACE_VERSION=37-2e0c2d
 USER_ID=$(id -u)
 GROUP_ID=$(id -g)
 
-for FILE in ${PATH_PROJECT}/*/anat/*T1w_orig.nii.gz; do
+for FILE in ${PATH_PROJECT}/${SUBJECT}/anat/*T1w_orig.nii.gz; do
     # get the filename:
 	FILE_BASENAME="$(basename -- $FILE)"
     # get the parent directory:
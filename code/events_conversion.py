@@ -1,12 +1,12 @@
 # This script converts psychopy log files into a single CSV.
 
 # target format is similar to this https://gin.g-node.org/lnnrtwttkhn/highspeed-bids/src/master/sub-01/ses-01/func/sub-01_ses-01_task-highspeed_rec-prenorm_run-03_events.tsv
-import pandas as pd
+import os
+import json
+import argparse
 import datetime
-from tqdm import tqdm
 import numpy as np
-import json
-from collections import defaultdict
+# pandas takes long to import, it is only imported where dataframes are built
 # import psychopy  # you should be running python 3.8 or 3.10
 # from psychopy.misc import fromFile
 # assert psychopy.__version__.startswith('2024.2'), f'psychopy needs to be version 2024.2 to load the files but {psychopy.__version__=}'
@@ -19,29 +19,107 @@ def extract_datetime(file):
     minute, second, *_ = minute_second_micro.split('.')
     return datetime.datetime(year, month, day, int(hour), int(minute), int(second))
 
-def add_row(df, **new_row):
-    """add a row to a dataframe, inplace with varying arguments.
-    all keywords that don't exist will be be added as columns to the df
+
+def _value_kind(value):
+    """classify a cell value the way pandas infers a single-row frame"""
+    if isinstance(value, (bool, np.bool_)):
+        return 'bool'
+    if isinstance(value, (int, np.integer)):
+        return 'int'
+    if isinstance(value, (float, np.floating)):
+        return 'nan' if value!=value else 'float'
+    return 'object'
+
+
+class EventAccumulator():
+    """collect event rows in append-only columnar buffers.
+
+    Instead of enlarging a dataframe for every single event (which copies
+    the whole frame each time), values are appended to one list per column
+    and the dataframe is only created once in `to_dataframe`. Columns that
+    appear for the first time are backfilled with NaN, rows that don't
+    mention a column get NaN.
+
+    To keep the written TSVs identical to adding the rows one by one with
+    `df.loc[len(df)] = row`, the dtype of every column is tracked like that
+    would upcast it (e.g. a bool landing in a float column is stored as 1.0).
 
     Parameters
     ----------
-    df : dataframe to add a row to
-    onset : only required argument
-    kwargs: keyword argument to add as columns
-
-    Returns None
+    columns : column names that should be present from the start
     """
-    # make sure these are present
-    assert 'onset' in new_row
-    assert 'condition' in new_row
-    if 'duration' in new_row:
-        new_row['duration'] = round(new_row['duration'], 4)
-    # if column doesnt exist, create it
-    for name in new_row:
-        if name not in df.columns:
-            df[name]= [np.nan]*len(df)
-    df.loc[len(df)] = new_row
-    return None  # it works in-place, so no return of df
+    def __init__(self, columns=()):
+        self.columns = {name: [] for name in columns}
+        self.dtypes = {name: 'nan' for name in columns}
+        self.n_rows = 0
+
+    def __len__(self):
+        return self.n_rows
+
+    def _append(self, name, value):
+        """append value to column `name`, upcasting like DataFrame.loc"""
+        values = self.columns[name]
+        kind = _value_kind(value)
+        dtype = self.dtypes[name]
+        if self.n_rows==0:
+            # first row of an empty frame: dtype is inferred from the value
+            self.dtypes[name] = kind
+        elif dtype=='object':
+            pass
+        elif kind=='object':
+            self.dtypes[name] = 'object'
+        elif dtype in ('nan', 'float'):
+            if kind in ('bool', 'int'):
+                value = float(value)
+            if dtype=='nan' and kind=='bool':
+                self.dtypes[name] = 'object'
+            elif kind!='nan':
+                self.dtypes[name] = 'float'
+        elif dtype=='bool' and kind in ('bool', 'int'):
+            self.dtypes[name] = kind
+            values[:] = [int(x) for x in values] if kind=='int' else values
+        elif dtype=='int' and kind in ('bool', 'int'):
+            value = int(value)
+        else:
+            # int/bool column receives a float or NaN
+            self.dtypes[name] = 'float' if dtype=='int' else 'object'
+            values[:] = [float(x) for x in values]
+            value = float(value)
+        values.append(value)
+
+    def add_row(self, **new_row):
+        """add a row with varying arguments. All keywords that don't exist
+        yet will be added as columns
+
+        Parameters
+        ----------
+        onset : required argument
+        condition : required argument
+        kwargs: keyword argument to add as columns
+
+        Returns None
+        """
+        assert 'onset' in new_row
+        assert 'condition' in new_row
+        if 'duration' in new_row:
+            new_row['duration'] = round(new_row['duration'], 4)
+        # if column doesnt exist, create it and backfill previous rows
+        for name in new_row:
+            if name not in self.columns:
+                self.columns[name] = [np.nan]*self.n_rows
+                self.dtypes[name] = 'nan'
+        for name in self.columns:
+            self._append(name, new_row.get(name, np.nan))
+        self.n_rows += 1
+
+    def to_dataframe(self):
+        """create the dataframe from the collected columns"""
+        import pandas as pd
+        numpy_dtypes = {'nan': float, 'float': float, 'int': np.int64,
+                        'bool': bool, 'object': object}
+        return pd.DataFrame({name: pd.Series(values, dtype=numpy_dtypes[self.dtypes[name]])
+                             for name, values in self.columns.items()})
+
 
 def json_decode(cell):
     """convert strings to lists , e..g "[1,2]" => [1, 2]"""
@@ -53,268 +131,433 @@ def json_decode(cell):
 
 
 
-#%% actual conversion code
-output_dir = 'Z:/Fast-Replay-7T/output/'
-psychopy_data = 'Z:/Fast-Replay-7T/data_cleaned' # directory where psychopy log files for the experiment are stored
-
-# some definitions
-intervals = np.array([32, 64, 128, 512])
-stimuli = ['gesicht', 'haus', 'katze', 'schuh', 'stuhl']
-key_mapping = {'r': 'right', 'y': 'down', 'b': 'right', 'g': 'left'}
+def read_psychopy_log(log_file, components=None, props=None, block_size=2**24):
+    """stream the property assignments of a psychopy log file.
 
+    The file is read in blocks of `block_size` characters. Lines of
+    components that are not requested are dropped before they are split
+    up, so memory use only depends on the number of retained entries.
 
-def convert_psychopy_to_bids(csv_file):
-    # load the log file (only there we have the image labels, what?!)
-    with open(csv_file[:-3] + 'log', 'r') as f:
-        loglines = f.readlines()
-        # build lookup dictionary
-        # this is increasingly ugly, but it creates a nested dict of a nested dict
-        log_dict = defaultdict(lambda: defaultdict(dict))
-        for line in loglines:
-            t, lvl, msg = [x.strip() for x in line.split('\t', 3)]
+    Parameters
+    ----------
+    log_file : path to the .log file
+    components : names of the components to keep, None to keep all
+    props : names of the properties to keep, None to keep all
+    block_size : number of characters to read at once
+
+    Yields
+    ------
+    (timestamp, component, property, value) for each property assignment
+    """
+    components = None if components is None else set(components)
+    props = None if props is None else set(props)
+
+    def parse(lines):
+        for line in lines:
+            # cheap check on the component name first, message is after the last tab
+            msg = line[line.rfind('\t')+1:]
+            sep = msg.find(': ')
+            if sep<0: continue  # only record property assignments
+            if components is not None and msg[:sep].strip() not in components: continue
+
+            parts = line.split('\t')
+            if len(parts)!=3: continue  # not a log entry, e.g. empty line
+            t, lvl, msg = [x.strip() for x in parts]
             if msg.startswith('Created'): continue  # ignore creation events
             if not ' = ' in msg: continue  # only record property assignments
-            if not ': ' in msg: continue  # only record property assignments
             if lvl=='DATA': continue  # ignore keypresses
             cmp_name, msg = msg.split(': ', 1)
             prop, val = msg.split(' = ', 1)
-            log_dict[float(t)][cmp_name][prop] = val
+            if props is not None and prop not in props: continue
+            yield float(t), cmp_name, prop, val
 
-    # load the CSV file
-    df_run = pd.read_csv(csv_file)
+    with open(log_file, 'r') as f:
+        rest = ''
+        while block := f.read(block_size):
+            lines = (rest + block).split('\n')
+            rest = lines.pop()  # possibly incomplete, prepend to next block
+            yield from parse(lines)
+        yield from parse([rest])
 
-    df_run_bids = pd.DataFrame(columns=['onset', 'duration', 'subject', 'session', 'condition', 'trial_type'])
-
-    # loop over all trials
-
-    for i, line in tqdm(df_run.iterrows(), total=len(df_run), desc='extracting events'):
-        line = line[~line.isna()]  # filter all NaN entries, makes it a bit easier to debug
-        line = line.apply(json_decode)  # convert strings to python datatypes
-
-        condition = 'other'  # default condition
-        # parse which trial this currently is
-        if 'language_selection_screen.started' in line:
-            condition = 'instruction'
-            component = 'language_selection_screen'
-            add_row(df_run_bids,
-                    onset=line[f'{component}.started'],
-                    duration=line[f'{component}.stopped'] - line[f'{component}.started'],
-                    condition=condition,
-                    trial_type= 'instruction',
-                    stim_label='language_selection',
-                    key_down='german' if line['choice_key.keys']=='g' else 'english',
-                    )
-            continue
 
-        # ignore instructions
-        elif 'instruct_pre1.started' in line:
-            continue
+class PsychopyLog():
+    """index of the property assignments of a psychopy .log file.
 
-        elif 'instruct_pre2.started' in line:
+    Timestamps are kept in a NumPy array, component and property names are
+    interned as integer codes. Entries are sorted by (component, property,
+    time), so all entries of one component property are a contiguous slice
+    that can be searched with `np.searchsorted`.
+
+    Parameters
+    ----------
+    times : timestamps of the entries
+    components, props : component and property name of each entry
+    values : the assigned values, as strings
+    """
+    def __init__(self, times, components, props, values):
+        self.component_names = {}
+        self.prop_names = {}
+        component_codes = [self.component_names.setdefault(c, len(self.component_names)) for c in components]
+        prop_codes = [self.prop_names.setdefault(p, len(self.prop_names)) for p in props]
+
+        # stable sort, so for identical timestamps the last assignment wins
+        order = np.lexsort((np.asarray(times, dtype=float), prop_codes, component_codes))
+        self.times = np.asarray(times, dtype=float)[order]
+        self.components = np.asarray(component_codes, dtype=np.int32)[order]
+        self.props = np.asarray(prop_codes, dtype=np.int32)[order]
+        self.values = np.asarray(values, dtype=object)[order]
+
+        # start and stop of the slice of each (component, property)
+        keys = self.components.astype(np.int64) << 32 | self.props
+        starts = np.flatnonzero(np.r_[True, keys[1:]!=keys[:-1]]) if len(keys) else np.array([], int)
+        stops = np.r_[starts[1:], len(keys)]
+        self.slices = {(int(self.components[i]), int(self.props[i])): (i, j)
+                       for i, j in zip(starts, stops)}
+
+    def __len__(self):
+        return len(self.times)
+
+    @classmethod
+    def from_file(cls, log_file, components=None, props=None):
+        """index the property assignments of a psychopy log file,
+        optionally only of some components/properties, see `read_psychopy_log`"""
+        times, component_names, prop_names, values = [], [], [], []
+        for t, cmp_name, prop, val in read_psychopy_log(log_file, components, props):
+            times.append(t)
+            component_names.append(cmp_name)
+            prop_names.append(prop)
+            values.append(val)
+        return cls(times, component_names, prop_names, values)
+
+    def lookup(self, onsets, component, prop, tolerance=1e-4):
+        """get the value of `component.prop` set closest to each onset.
+
+        Parameters
+        ----------
+        onsets : timestamps to look up
+        component, prop : name of the component and property
+        tolerance : maximum distance in seconds between onset and log entry
+
+        Returns
+        -------
+        values : object array with one value per onset
+        """
+        onsets = np.asarray(onsets, dtype=float)
+        key = (self.component_names.get(component), self.prop_names.get(prop))
+        start, stop = self.slices.get(key, (0, 0))
+        times = self.times[start:stop]
+        if not len(times):
+            if len(onsets):
+                raise KeyError(f'{component}.{prop} never set in log')
+            return np.array([], dtype=object)
+
+        # compare the closest entries before and after each onset
+        after = np.searchsorted(times, onsets, side='right').clip(max=len(times)-1)
+        before = (after - 1).clip(min=0)
+        closest = np.where(np.abs(onsets - times[before]) <= np.abs(times[after] - onsets),
+                           before, after)
+        missing = ~(np.abs(times[closest] - onsets) <= tolerance)
+        if missing.any():
+            raise KeyError(f'{component}.{prop} not in log at {onsets[missing]}')
+        return self.values[start + closest]
+
+    def lookup_batch(self, queries, tolerance=1e-4):
+        """resolve several lookups in one call.
+
+        Parameters
+        ----------
+        queries : dict of name -> (onsets, component, prop)
+
+        Returns
+        -------
+        dict of name -> object array of values, see `lookup`
+        """
+        return {name: self.lookup(onsets, component, prop, tolerance=tolerance)
+                for name, (onsets, component, prop) in queries.items()}
+
+
+#%% actual conversion code
+# some definitions
+intervals = np.array([32, 64, 128, 512])
+stimuli = ['gesicht', 'haus', 'katze', 'schuh', 'stuhl']
+key_mapping = {'r': 'right', 'y': 'down', 'b': 'right', 'g': 'left'}
+# components of which we need properties from the log file
+log_components = ['localizer_img', 'loc_feedback', 'cue_text', 'question_text'] + \
+                 [f'sequence_img_{seq}' for seq in range(1, 6)]
+# trial types and the routine that marks them, in order of precedence
+trial_components = {'language_selection': 'language_selection_screen',
+                    'instruct_pre1': 'instruct_pre1',
+                    'instruct_pre2': 'instruct_pre2',
+                    'localizer': 'localizer',
+                    'sequence': 'sequence',
+                    'buffer_2': 'buffer_2',
+                    'break_2': 'break_2',
+                    'instruct_end': 'instruct_end'}
+
+
+def classify_trials(df_run):
+    """determine the trial type of every row of a psychopy CSV at once.
+
+    The type is given by the first of the routines in `trial_components`
+    that has a `.started` entry in that row. Rows without any of them
+    that only have a few entries are empty rows and marked with ''.
+    """
+    trials = np.full(len(df_run), '', dtype=object)
+    undetermined = np.ones(len(df_run), dtype=bool)
+    for trial, component in trial_components.items():
+        if f'{component}.started' not in df_run:
             continue
+        is_trial = undetermined & df_run[f'{component}.started'].notna().to_numpy()
+        trials[is_trial] = trial
+        undetermined &= ~is_trial
 
-        elif 'localizer.started' in line:  # this row is a localizer trial
-            condition = 'localizer'
-
-            # there are several events within this trial that we need to transfer
-            # 1 fixation dot pre, only once before the entire block
-            #### somehow missing
-
-            # 2 fixation dot pre, before every image
-            # component = 'localizer_fixation'
-            if f'{component}.stopped' in line and f'{component}.started' in line:
-                add_row(df_run_bids,
-                    onset=line[f'{component}.started'],
-                    duration=line[f'{component}.stopped'] - line[f'{component}.started'],
-                    condition=condition,
-                    trial_type= 'fixation',
-                    stim_label='dot')
-
-            # 3 image itself
-            component = 'localizer_img'
-            onset = line[f'{component}.started']
-            orientation = log_dict[round(onset, 4)][component]['ori']
-            stim_label = log_dict[round(onset, 4)][component]['image'].split('/')[-1][:-5]
-            stim_index = stimuli.index(stim_label.lower())+1
-
-            add_row(df_run_bids,
-                    onset=onset,
-                    duration=line[f'{component}.stopped'] - onset,
-                    condition=condition,
-                    trial_type= 'stimulus',
-                    stim_label= stim_label,
-                    orientation=orientation,
-                    interval_time=line[f'localizer_isi.stopped'] - line[f'localizer_isi.started'],
-                    response_time=line['key_resp_localizer.rt'] if 'key_resp_localizer.rt' in line else np.nan,
-                    accuracy= ('key_resp_localizer.rt' in line)==(orientation=='180')
-                    )
-                    # accuracy=
-            del onset, orientation, stim_label, stim_index  # for safety, not to accidentially reuse it later
-
-            # 4 ISI
-            component = 'localizer_isi'
-            add_row(df_run_bids,
-                    onset=line[f'{component}.started'],
-                    duration=line[f'{component}.stopped'] - line[f'{component}.started'],
-                    condition=condition,
-                    trial_type= 'blank',
-                    stim_label='interval')
-
-            # 5 feedback, if given
-            component = 'loc_feedback'
-            if f'{component}.started' in line:
-                onset = line[f'{component}.started']
-                add_row(df_run_bids,
-                        onset=onset,
-                        duration=line[f'{component}.stopped'] - onset,
-                        condition=condition,
-                        trial_type= 'feedback',
-                        stim_label=log_dict[round(onset, 4)][component]['foreColor'])
-                del onset
-
-
-        elif 'sequence.started' in line:
-            condition = 'sequence'
-
-            # 1 Cue of which item to look out for
-            component = 'cue'
-            onset = line[f'{component}_text.started']
-            cue_label = log_dict[round(onset, 4)][component + '_text']['text'].replace("'", "")
-            add_row(df_run_bids,
-                    onset=line[f'{component}.started'],
-                    duration=line[f'{component}.stopped'] - line[f'{component}.started'],
-                    condition=condition,
-                    trial_type= 'cue',
-                    stim_label=cue_label)
-            del onset
-
-            # 2 empty blank for 1500 ms
-            component = 'blank1500'
-            add_row(df_run_bids,
-                    onset=line[f'{component}.started'],
-                    duration=line[f'{component}.stopped'] - line[f'{component}.started'],
-                    condition=condition,
-                    trial_type= 'blank',
-                    stim_label='blank')
-
-            # 3 fixation dot before sequence
-            component = 'fixation_dot'
-            add_row(df_run_bids,
-                    onset= line[f'{component}.started'],
-                    duration=line[f'{component}.stopped'] -  line[f'{component}.started'],
-                    condition=condition,
-                    trial_type= 'fixation',
-                    stim_label='dot')
-
-            # 4 sequences of five images
-            onset_seq1 = round(line['sequence_img_1.started'], 4)
-            correct_idx = -1  # save which press would have been correct
-            for seq in range(1, 6):
-
-                elapsed = (line[f'sequence_isi_{seq}.stopped'] - line[f'sequence_isi_{seq}.started'])*1000
-                interval = intervals[np.argmin(abs(intervals - elapsed))]
-
-                # 4.1 image
-                component = f'sequence_img_{seq}'
-                stim_label = log_dict[onset_seq1][component]['image'].split('/')[-1][:-5]
-                stim_index = stimuli.index(stim_label.lower())+1
-                if stim_label==cue_label:
-                    assert correct_idx==-1  # make sure we're not overwriting something
-                    correct_idx=seq
-
-                add_row(df_run_bids,
-                    onset=line[f'{component}.started'],
-                    duration=line[f'{component}.stopped'] - line[f'{component}.started'],
-                    condition=condition,
-                    trial_type= 'stimulus',
-                    stim_index=stim_index,
-                    stim_label=stim_label,
-                    serial_position=seq,
-                    interval_time=interval)
-                del stim_label, stim_index  # for safety, remove
-
-                # 4.2 ISI
-                component = f'sequence_isi_{seq}'
-                add_row(df_run_bids,
-                        onset=line[f'{component}.started'],
-                        duration=line[f'{component}.stopped'] - line[f'{component}.started'],
-                        condition=condition,
-                        trial_type= 'interval',
-                        stim_label= 'dot')
-            assert correct_idx>0, 'no target stimulus found? error in code.'
-
-            component = f'buffer_fixation'
-            add_row(df_run_bids,
-                    onset=line[f'{component}.started'],
-                    duration=line[f'{component}.stopped'] - line[f'{component}.started'],
-                    condition=condition,
-                    trial_type= 'delay',
-                    stim_label= 'dot')
-
-            component = f'question'
-            t_feedback = round(line['text_feedback__answer.started'], 4)
-            choices = log_dict[round(line[f'{component}_text.started'], 4)][f'{component}_text']['text']
-            choices = [int(x.strip()) for x in choices.split('\\n')[-1][:-1].split('?')]
-
-            key_expected = 'left' if choices.index(correct_idx)==0 else 'right'
-            key_down = key_mapping[line['question_key_resp.keys']] if 'question_key_resp.rt' in line else np.nan
-
-            add_row(df_run_bids,
-                    onset=line[f'{component}.started'],
-                    duration=line[f'{component}.stopped'] - line[f'{component}.started'],
-                    condition=condition,
-                    trial_type= 'choice',
-                    stim_label= 'choice',
-                    response_time=line['question_key_resp.rt'] if 'question_key_resp.rt' in line else np.nan,
-                    key_down=key_down,
-                    key_expected=key_expected,
-                    key_pressed=bool('question_key_resp.rt' in line),
-                    choice_left=choices[0],
-                    choice_right=choices[1],
-                    choice_correct=correct_idx,
-                    accuracy=key_down==key_expected,
-                    )
-
-            component = f'feedback'
-            add_row(df_run_bids,
-                    onset=line[f'{component}.started'],
-                    duration=line[f'{component}.stopped'] - line[f'{component}.started'],
-                    condition=condition,
-                    trial_type= 'feedback',
-                    )
-
-        elif 'buffer_2.started' in line:
-            condition = 'fixation'
-            component = 'buffer_2'
-            add_row(df_run_bids,
-                    onset=line[f'{component}.started'],
-                    duration=line[f'{component}.stopped'] - line[f'{component}.started'],
-                    condition=condition,
-                    trial_type= 'pre-fixation',
-                    stim_label= 'dot',
-                    )
-        elif 'break_2.started' in line:
-            component = 'break_2'
-            add_row(df_run_bids,
-                onset=line[f'{component}.started'],
-                duration=line[f'{component}.stopped'] - line[f'{component}.started'],
-                condition=condition,
-                trial_type= 'break',
-                stim_label= 'break',
-                )
-
-        elif 'instruct_end.started' in line:
-            component = 'instruct_end'
-            add_row(df_run_bids,
-                onset=line[f'{component}.started'],
-                duration=line[f'{component}.stopped'] - line[f'{component}.started'],
-                condition=condition,
-                trial_type= 'instruction',
-                stim_label= 'end-of-experiment',
-                )
-        elif len(line)<=10:
-            continue  # empty line
+    unknown = undetermined & (df_run.notna().sum(1).to_numpy() > 10)
+    if unknown.any():
+        raise ValueError(f'this is unknown: rows {np.where(unknown)[0]}')
+    return trials
 
-        else:
-            raise ValueError('this is unknown')
-    return df_run_bids
+
+def convert_psychopy_to_bids(csv_file):
+    import pandas as pd
+    # load the log file (only there we have the image labels, what?!)
+    log = PsychopyLog.from_file(csv_file[:-3] + 'log', components=log_components,
+                                props=['ori', 'image', 'foreColor', 'text'])
+
+    # load the CSV file
+    df_run = pd.read_csv(csv_file)
+    # only text columns can hold JSON, numeric columns are left untouched
+    for column in df_run.columns[df_run.dtypes==object]:
+        df_run[column] = df_run[column].map(json_decode)
+
+    trials = classify_trials(df_run)
+    loc_rows = np.where(trials=='localizer')[0]
+    seq_rows = np.where(trials=='sequence')[0]
+
+    def col(name, rows):
+        """values of column `name` at `rows`, NaN if the column is missing"""
+        if name not in df_run:
+            return np.full(len(rows), np.nan)
+        return df_run[name].to_numpy()[rows]
+
+    def duration(component, rows):
+        return col(f'{component}.stopped', rows) - col(f'{component}.started', rows)
+
+    # every event is queued as (row, position within trial, columns) and
+    # added in that order at the end, so the output has the same row and
+    # column order as when iterating over the trials one by one
+    queue = []
+    def add_events(rows, position, **columns):
+        columns = {name: (values.tolist() if isinstance(values, np.ndarray) else
+                          values if isinstance(values, list) else [values]*len(rows))
+                   for name, values in columns.items()}
+        for row, *values in zip(rows.tolist(), *columns.values()):
+            queue.append((row, position, dict(zip(columns, values))))
+
+    def add_simple_events(component, rows, position, **columns):
+        add_events(rows, position,
+                   onset=col(f'{component}.started', rows),
+                   duration=duration(component, rows),
+                   **columns)
+
+    # resolve all labels that are only stored in the log file in one go,
+    # all images of a sequence are set at the onset of the first image
+    feedback_rows = loc_rows[pd.notna(col('loc_feedback.started', loc_rows))]
+    onset_seq1 = col('sequence_img_1.started', seq_rows)
+    logged = log.lookup_batch({
+        'orientation': (col('localizer_img.started', loc_rows), 'localizer_img', 'ori'),
+        'localizer_img': (col('localizer_img.started', loc_rows), 'localizer_img', 'image'),
+        'loc_feedback': (col('loc_feedback.started', feedback_rows), 'loc_feedback', 'foreColor'),
+        'cue': (col('cue_text.started', seq_rows), 'cue_text', 'text'),
+        'question': (col('question_text.started', seq_rows), 'question_text', 'text'),
+        } | {f'sequence_img_{seq}': (onset_seq1, f'sequence_img_{seq}', 'image')
+             for seq in range(1, 6)})
+
+    ### language selection
+    rows = np.where(trials=='language_selection')[0]
+    key_down = np.where(col('choice_key.keys', rows)=='g', 'german', 'english')
+    add_simple_events('language_selection_screen', rows, 0,
+                      condition='instruction',
+                      trial_type='instruction',
+                      stim_label='language_selection',
+                      key_down=key_down)
+
+    ### localizer trials
+    rows = loc_rows
+    condition = 'localizer'
+
+    # 1 fixation dot pre, only once before the entire block
+    #### somehow missing
+
+    # 2 fixation dot pre, before every image. There is no fixation component
+    # in the CSV, historically this picked up whichever component the
+    # previous trial looked at last. Kept as is to not change the output.
+    last_component = {'language_selection': 'language_selection_screen',
+                      'localizer': 'loc_feedback', 'sequence': 'feedback',
+                      'buffer_2': 'buffer_2', 'break_2': 'break_2',
+                      'instruct_end': 'instruct_end'}
+    setting = np.where(np.isin(trials, list(last_component)))[0]
+    previous = np.searchsorted(setting, rows) - 1
+    prev_component = np.array([last_component[trials[setting[i]]] if i>=0 else ''
+                               for i in previous], dtype=object)
+    for component in set(prev_component) - {''}:
+        has_times = pd.notna(col(f'{component}.started', rows)) & \
+                    pd.notna(col(f'{component}.stopped', rows))
+        add_simple_events(component, rows[(prev_component==component) & has_times], 0,
+                          condition=condition,
+                          trial_type='fixation',
+                          stim_label='dot')
+
+    # 3 image itself
+    component = 'localizer_img'
+    onset = col(f'{component}.started', rows)
+    orientation = logged['orientation'].tolist()
+    stim_label = [x.split('/')[-1][:-5] for x in logged['localizer_img']]
+    for label in stim_label:
+        stimuli.index(label.lower())  # make sure we know all stimuli
+    response_time = col('key_resp_localizer.rt', rows)
+    pressed = pd.notna(response_time)
+    add_events(rows, 1,
+               onset=onset,
+               duration=duration(component, rows),
+               condition=condition,
+               trial_type='stimulus',
+               stim_label=stim_label,
+               orientation=orientation,
+               interval_time=duration('localizer_isi', rows),
+               response_time=response_time,
+               accuracy=[bool(p==(o=='180')) for p, o in zip(pressed, orientation)])
+
+    # 4 ISI
+    add_simple_events('localizer_isi', rows, 2,
+                      condition=condition,
+                      trial_type='blank',
+                      stim_label='interval')
+
+    # 5 feedback, if given
+    component = 'loc_feedback'
+    add_simple_events(component, feedback_rows, 3,
+                      condition=condition,
+                      trial_type='feedback',
+                      stim_label=logged['loc_feedback'])
+
+    ### sequence trials
+    rows = seq_rows
+    condition = 'sequence'
+
+    # 1 Cue of which item to look out for
+    cue_label = [x.replace("'", "") for x in logged['cue']]
+    add_simple_events('cue', rows, 0,
+                      condition=condition,
+                      trial_type='cue',
+                      stim_label=cue_label)
+
+    # 2 empty blank for 1500 ms
+    add_simple_events('blank1500', rows, 1,
+                      condition=condition,
+                      trial_type='blank',
+                      stim_label='blank')
+
+    # 3 fixation dot before sequence
+    add_simple_events('fixation_dot', rows, 2,
+                      condition=condition,
+                      trial_type='fixation',
+                      stim_label='dot')
+
+    # 4 sequences of five images
+    seq_labels = np.array([[x.split('/')[-1][:-5] for x in logged[f'sequence_img_{seq}']]
+                           for seq in range(1, 6)], dtype=object).T.reshape(len(rows), 5)
+    is_target = seq_labels==np.array(cue_label, dtype=object)[:, None]
+    assert (is_target.sum(1)==1).all(), 'no or several target stimuli found? error in code.'
+    correct_idx = is_target.argmax(1) + 1  # save which press would have been correct
+
+    for seq in range(1, 6):
+        elapsed = duration(f'sequence_isi_{seq}', rows)*1000
+        interval = intervals[np.argmin(abs(intervals[None, :] - elapsed[:, None]), 1)]
+
+        # 4.1 image
+        stim_label = seq_labels[:, seq-1].tolist()
+        add_simple_events(f'sequence_img_{seq}', rows, 2*seq + 1,
+                          condition=condition,
+                          trial_type='stimulus',
+                          stim_index=[stimuli.index(x.lower())+1 for x in stim_label],
+                          stim_label=stim_label,
+                          serial_position=seq,
+                          interval_time=list(interval))
+
+        # 4.2 ISI
+        add_simple_events(f'sequence_isi_{seq}', rows, 2*seq + 2,
+                          condition=condition,
+                          trial_type='interval',
+                          stim_label='dot')
+
+    add_simple_events('buffer_fixation', rows, 13,
+                      condition=condition,
+                      trial_type='delay',
+                      stim_label='dot')
+
+    component = 'question'
+    choices = [[int(x.strip()) for x in c.split('\\n')[-1][:-1].split('?')]
+               for c in logged['question']]
+    key_expected = ['left' if c.index(correct)==0 else 'right'
+                    for c, correct in zip(choices, correct_idx.tolist())]
+    response_time = col('question_key_resp.rt', rows)
+    key_pressed = pd.notna(response_time)
+    key_down = [key_mapping[key] if pressed else np.nan for key, pressed in
+                zip(col('question_key_resp.keys', rows), key_pressed)]
+    add_simple_events(component, rows, 14,
+                      condition=condition,
+                      trial_type='choice',
+                      stim_label='choice',
+                      response_time=response_time,
+                      key_down=key_down,
+                      key_expected=key_expected,
+                      key_pressed=key_pressed.tolist(),
+                      choice_left=[c[0] for c in choices],
+                      choice_right=[c[1] for c in choices],
+                      choice_correct=correct_idx,
+                      accuracy=[d==e for d, e in zip(key_down, key_expected)])
+
+    add_simple_events('feedback', rows, 15,
+                      condition=condition,
+                      trial_type='feedback')
+
+    ### fixation, breaks and end of experiment
+    add_simple_events('buffer_2', np.where(trials=='buffer_2')[0], 0,
+                      condition='fixation',
+                      trial_type='pre-fixation',
+                      stim_label='dot')
+    add_simple_events('break_2', np.where(trials=='break_2')[0], 0,
+                      condition='other',
+                      trial_type='break',
+                      stim_label='break')
+    add_simple_events('instruct_end', np.where(trials=='instruct_end')[0], 0,
+                      condition='other',
+                      trial_type='instruction',
+                      stim_label='end-of-experiment')
+
+    df_run_bids = EventAccumulator(columns=['onset', 'duration', 'subject', 'session', 'condition', 'trial_type'])
+    for _, _, event in sorted(queue, key=lambda x: x[:2]):
+        df_run_bids.add_row(**event)
+    return df_run_bids.to_dataframe()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='convert psychopy runs of the main task to BIDS events')
+    parser.add_argument('csv_files', nargs='+',
+                        help='psychopy CSV files, each with its .log file next to it')
+    parser.add_argument('--out-dir', default=None,
+                        help='folder of the events .tsv files, default: next to each CSV')
+    args = parser.parse_args(argv)
+
+    for csv_file in args.csv_files:
+        df_run_bids = convert_psychopy_to_bids(csv_file)
+        out_dir = args.out_dir or os.path.dirname(os.path.abspath(csv_file))
+        os.makedirs(out_dir, exist_ok=True)
+        tsv_file = f'{out_dir}/{os.path.basename(csv_file)[:-4]}_events.tsv'
+        df_run_bids.to_csv(tsv_file, sep='\t', index=False, na_rep='NaN')
+        print(f'{len(df_run_bids)} events written to {tsv_file}')
+    return 0
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 19:02:37 2026
+
+lightweight timing and memory instrumentation of the conversion steps.
+
+Wrap a step in `stage('name')` to record its wall and CPU time and the
+peak RSS of the process while it ran. The RSS is sampled by a single
+background thread per process. If tracemalloc is running, the peak of the
+traced allocations is recorded as well. Nested stages inherit the labels
+of the stage they run in, within the same thread. CPU time and RSS are
+those of the whole process, so they include other threads that overlap.
+Records are kept per process and returned by `collect`, e.g. to send them
+from a worker to the main process.
+
+@author: simon.kern
+"""
+import os
+import json
+import time
+import cProfile
+import threading
+import tracemalloc
+from contextlib import contextmanager
+import psutil
+
+sample_interval = 0.05  # seconds between two RSS samples
+
+_records = []  # finished stages of this process
+_active = []  # stages that are running, of all threads
+_local = threading.local()  # labels of the running stages of this thread
+_context = {}  # labels added to every record, e.g. subject and task
+_lock = threading.Lock()
+_sampler_pid = None
+
+
+def _sample_rss():
+    process = psutil.Process()
+    while True:
+        rss = process.memory_info().rss / 1024**2
+        with _lock:
+            for record in _active:
+                record['rss_peak_mb'] = max(record['rss_peak_mb'], rss)
+        time.sleep(sample_interval)
+
+
+def _update_alloc_peak():
+    """add the traced peak since the last reset to all running stages"""
+    peak = tracemalloc.get_traced_memory()[1] / 1024**2
+    for record in _active:
+        record['alloc_peak_mb'] = max(record.get('alloc_peak_mb', 0), peak)
+    tracemalloc.reset_peak()
+
+
+@contextmanager
+def context(**labels):
+    """add labels (e.g. subject='01') to all stages recorded in the block"""
+    previous = _context.copy()
+    _context.update(labels)
+    try:
+        yield
+    finally:
+        _context.clear()
+        _context.update(previous)
+
+
+@contextmanager
+def stage(name, **labels):
+    """record wall time, CPU time and peak memory of the block"""
+    global _sampler_pid
+    if _sampler_pid!=os.getpid():
+        _sampler_pid = os.getpid()
+        threading.Thread(target=_sample_rss, daemon=True).start()
+
+    rss = psutil.Process().memory_info().rss / 1024**2
+    stack = _local.__dict__.setdefault('stack', [])
+    labels = _context | (stack[-1] if stack else {}) | labels
+    record = labels | {'stage': name, 'pid': os.getpid(), 'error': None,
+                       'rss_start_mb': rss, 'rss_peak_mb': rss}
+    stack.append(labels)
+    with _lock:
+        if tracemalloc.is_tracing():
+            _update_alloc_peak()
+        _active.append(record)
+    start, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = type(e).__name__
+        raise
+    finally:
+        record['wall_s'] = time.perf_counter() - start
+        record['cpu_s'] = time.process_time() - start_cpu
+        record['rss_end_mb'] = psutil.Process().memory_info().rss / 1024**2
+        with _lock:
+            if tracemalloc.is_tracing():
+                _update_alloc_peak()
+            _active[:] = [r for r in _active if r is not record]
+        stack.pop()
+        record['rss_peak_mb'] = max(record['rss_peak_mb'], record['rss_end_mb'])
+        _records.append(record)
+
+
+def collect():
+    """return and remove all records of this process"""
+    records = _records.copy()
+    _records.clear()
+    return records
+
+
+@contextmanager
+def profile(prof_file):
+    """run the block under cProfile and write the stats to prof_file, does
+    nothing if prof_file is None. Inspect with `python -m pstats prof_file`"""
+    if prof_file is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(os.path.dirname(prof_file), exist_ok=True)
+        profiler.dump_stats(prof_file)
+
+
+def write_report(report_file, records, **info):
+    """write the run report as json (info and all records) and the
+    records alone as csv next to it"""
+    import pandas as pd  # not needed by the workers, which only record
+    os.makedirs(os.path.dirname(report_file), exist_ok=True)
+    with open(report_file, 'w') as f:
+        json.dump(info | {'stages': records}, f, indent=1, default=str)
+    pd.DataFrame(records).to_csv(report_file[:-5] + '.csv', index=False)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 10:12:41 2026
+
+keeps track of which source files (and which version of the conversion code)
+were used to create which BIDS outputs, so that re-running the conversion
+only touches outputs that are out of date.
+
+@author: simon.kern
+"""
+import os
+import json
+import glob
+import fcntl
+import hashlib
+import inspect
+from contextlib import contextmanager
+
+
+def hash_file(file, chunk_size=2**24):
+    """sha1 of the content of a file, read in chunks"""
+    sha1 = hashlib.sha1()
+    with open(file, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+# lock files of `file_lock`, outside of the dataset
+lock_dir = os.path.expanduser('~/.cache/fastreplay-MEG-bids/locks/')
+
+
+@contextmanager
+def file_lock(file):
+    """lock `file` against other processes that lock it, e.g. for reading
+    and rewriting it. The lock is held on a file in `lock_dir`, named after
+    the absolute path of `file`"""
+    path = os.path.abspath(file)
+    lock_file = f'{lock_dir}{os.path.basename(path)}-{hashlib.sha1(path.encode()).hexdigest()[:12]}.lock'
+    os.makedirs(lock_dir, exist_ok=True)
+    with open(lock_file, 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def code_version(*objects):
+    """hash of the source code of functions/modules and the repr of any
+    other object (e.g. an event_id dict), used as version stamp"""
+    sha1 = hashlib.sha1()
+    for obj in objects:
+        if inspect.ismodule(obj) or inspect.isfunction(obj) or inspect.isclass(obj):
+            obj = inspect.getsource(obj)
+        sha1.update(repr(obj).encode())
+    return sha1.hexdigest()[:12]
+
+
+class Manifest():
+    """persistent record of the sources that each output was built from.
+
+    Each entry is stored under a key (e.g. 'sub-01_task-main_meg') with the
+    size, mtime and content hash of all its source files and the version
+    stamp of the code that created it. Files are only re-hashed if their
+    size or mtime changed. Several processes can update the same manifest,
+    each only writes the entries it changed.
+
+    Parameters
+    ----------
+    manifest_file : json file to store the manifest in
+    """
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        self.entries = self.load()
+        self.changed = set()
+
+    def load(self):
+        if not os.path.isfile(self.manifest_file):
+            return {}
+        with open(self.manifest_file, 'r') as f:
+            return json.load(f)
+
+    def save(self):
+        """write the changed entries to disk, atomically, keeping the
+        entries that other processes saved in the meantime"""
+        with file_lock(self.manifest_file):
+            self.entries = self.load() | {key: self.entries[key] for key in self.changed}
+            tmp_file = f'{self.manifest_file}.{os.getpid()}.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(tmp_file, self.manifest_file)
+        self.changed = set()
+
+    def signature(self, file, previous=None):
+        """size, mtime and hash of a file, reuse the previous hash if
+        size and mtime didn't change"""
+        stat = os.stat(file)
+        sig = {'size': stat.st_size, 'mtime': stat.st_mtime}
+        if previous and all(previous.get(k)==v for k, v in sig.items()):
+            sig['sha1'] = previous['sha1']
+        else:
+            sig['sha1'] = hash_file(file)
+        return sig
+
+    def is_up_to_date(self, key, sources, outputs, version):
+        """check if the outputs of `key` exist and were built from the same
+        sources with the same version of the conversion code.
+
+        Parameters
+        ----------
+        key : name of the entry
+        sources : list of source files
+        outputs : list of output files or glob patterns, each needs to exist
+        version : version stamp of the conversion code, see `code_version`
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry['version']!=version:
+            return False
+        if sorted(entry['sources'])!=sorted(os.path.abspath(f) for f in sources):
+            return False
+        if not all(glob.glob(output) for output in outputs):
+            return False
+        for file, previous in entry['sources'].items():
+            if not os.path.isfile(file):
+                return False
+            sig = self.signature(file, previous)
+            if sig['size']!=previous['size'] or sig['sha1']!=previous['sha1']:
+                return False
+        return True
+
+    def make_entry(self, key, sources, version):
+        """create the entry for an output that was just built. This does not
+        modify the manifest, so it can be called in a worker process"""
+        previous = self.entries.get(key, {}).get('sources', {})
+        sources = [os.path.abspath(f) for f in sources]
+        return {'version': version,
+                'sources': {f: self.signature(f, previous.get(f)) for f in sources}}
+
+    def update(self, key, entry):
+        """add an entry created by `make_entry`, e.g. in a worker process"""
+        self.entries[key] = entry
+        self.changed.add(key)
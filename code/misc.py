@@ -6,18 +6,184 @@ Created on Fri Aug  8 11:43:48 2025
 @author: simon.kern
 """
 import os
+import json
+import hashlib
 from functools import cache
 import numpy as np
 import mne
+import instrument
+from joblib import dump as joblib_dump
 from joblib import load as _joblib_load
 
 joblib_load = cache(_joblib_load)
 
-def check_and_fix_channels(raw):
-    """check for missing channels or empty channels or NaN channels"""
+# interpolation matrices are stored here and reused across runs
+cache_dir = os.path.expanduser('~/.cache/fastreplay-MEG-bids/')
+# channels that every recording should have, relative to the working directory
+template_file = 'template-info.fif'
+
+
+@cache
+def load_template_info(fname=template_file):
+    """read the info of the template recording, only once per process"""
+    return mne.io.read_info(fname, verbose='WARNING')
+
+
+def interpolate_bads_cached(raw, mode='accurate', block_size=20000):
+    """interpolate bad MEG channels like raw.interpolate_bads(), but the
+    interpolation matrix is cached on disk.
+
+    The matrix only depends on the sensor geometry, the head position, the
+    head origin and which channels are bad, so it is stored under a hash of
+    these and interpolation becomes a single matrix multiplication. It is
+    applied in place in blocks of `block_size` samples, so no copy of the
+    good channels is made, which also keeps memory-mapped data on disk.
+    """
+    from mne.forward import _map_meg_or_eeg_channels
+    from mne.bem import _check_origin
+
+    picks_meg = mne.pick_types(raw.info, meg=True, ref_meg=False, exclude=[])
+    bads = sorted(ch for ch in raw.info['bads'] if raw.ch_names.index(ch) in picks_meg)
+    picks_good = mne.pick_types(raw.info, meg=True, ref_meg=False, exclude='bads')
+    picks_bad = [raw.ch_names.index(ch) for ch in bads]
+    origin = _check_origin('auto', raw.info)
+
+    geometry = [(ch['ch_name'], ch['coil_type'], ch['loc'].round(6).tolist())
+                for ch in mne.pick_info(raw.info, picks_meg)['chs']]
+    dev_head_t = raw.info['dev_head_t']['trans'].round(6).tolist()
+    key = repr((geometry, dev_head_t, origin.round(6).tolist(), bads, mode))
+    cache_file = f'{cache_dir}/interpolation_{hashlib.sha1(key.encode()).hexdigest()}.pkl'
+
+    if os.path.isfile(cache_file):
+        mapping = joblib_load(cache_file)
+    else:
+        info_from = mne.pick_info(raw.info, picks_good)
+        info_to = mne.pick_info(raw.info, picks_bad)
+        mapping = _map_meg_or_eeg_channels(info_from, info_to, mode=mode, origin=origin)
+        os.makedirs(cache_dir, exist_ok=True)
+        # other processes might read the file at the same time
+        joblib_dump(mapping, f'{cache_file}.{os.getpid()}')
+        os.replace(f'{cache_file}.{os.getpid()}', cache_file)
+
+    for start in range(0, raw.n_times, block_size):
+        block = slice(start, start + block_size)
+        raw._data[picks_bad, block] = mapping @ raw._data[picks_good, block]
+    raw.info['bads'] = []
+    return raw
+
+def find_events(raw, chunk_size=200000, **kwargs):
+    """same as mne.find_events(raw, **kwargs), without loading the recording.
+
+    Only the stim channel(s) are kept while the recording is read in chunks
+    of `chunk_size` samples. The events are cached next to the
+    interpolation matrices, keyed on the source file, its size and mtime
+    and the arguments, so later runs don't need to read the file at all.
+    """
+    from mne.event import _get_stim_channel
+    stim_channel = _get_stim_channel(kwargs.pop('stim_channel', None), raw.info)
+
+    source = os.path.abspath(raw._filenames[0])
+    stat = os.stat(source)
+    key = repr((source, stat.st_size, stat.st_mtime, stim_channel, sorted(kwargs.items())))
+    cache_file = f'{cache_dir}/events/{os.path.basename(source)}_{hashlib.sha1(key.encode()).hexdigest()[:12]}.npy'
+    if os.path.isfile(cache_file):
+        return np.load(cache_file)
+
+    picks = [raw.ch_names.index(ch) for ch in stim_channel]
+    data = np.concatenate([raw.get_data(picks=picks, start=start, stop=start + chunk_size)
+                           for start in range(0, raw.n_times, chunk_size)], axis=1)
+    info = mne.create_info(stim_channel, raw.info['sfreq'], 'stim')
+    raw_stim = mne.io.RawArray(data, info, first_samp=raw.first_samp, verbose='WARNING')
+    events = mne.find_events(raw_stim, stim_channel=stim_channel, **kwargs)
+
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    np.save(f'{cache_file}.{os.getpid()}.npy', events)
+    os.replace(f'{cache_file}.{os.getpid()}.npy', cache_file)
+    return events
+
+
+def get_meas_date(fif_file):
+    """measurement date of a recording as POSIX timestamp, None if unknown.
+    Only the header is read and the result is cached like the events"""
+    source = os.path.abspath(fif_file)
+    stat = os.stat(source)
+    key = repr((source, stat.st_size, stat.st_mtime))
+    cache_file = f'{cache_dir}/meas_date/{os.path.basename(source)}_{hashlib.sha1(key.encode()).hexdigest()[:12]}.json'
+    if os.path.isfile(cache_file):
+        with open(cache_file, 'r') as f:
+            return json.load(f)
+
+    meas_date = mne.io.read_info(source, verbose='ERROR')['meas_date']
+    timestamp = meas_date.timestamp() if meas_date else None
+
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    with open(f'{cache_file}.{os.getpid()}', 'w') as f:
+        json.dump(timestamp, f)
+    os.replace(f'{cache_file}.{os.getpid()}', cache_file)
+    return timestamp
+
+
+def prefetch_file(fname, block_size=2**24):
+    """read a file once, so that it's in the page cache of the OS when mne
+    reads it. Used to read from the network storage in a background thread,
+    the data isn't kept in memory of the process"""
+    buffer = bytearray(block_size)
+    with open(fname, 'rb', buffering=0) as f:
+        while f.readinto(buffer):
+            pass
+
+
+def scan_channels(raw, block_size=20000):
+    """scan all channels for NaN, Inf and flat signals.
+
+    The data is read in blocks of `block_size` samples, so peak memory is
+    bounded by the block size and not by the length of the recording.
+
+    Returns
+    -------
+    report : dict with channel name -> {'n_nan', 'n_inf', 'flat', 'zero'},
+             'flat' means the channel is constant, 'zero' that it is all 0
+    """
+    n_chs = len(raw.ch_names)
+    n_nan = np.zeros(n_chs, dtype=int)
+    n_inf = np.zeros(n_chs, dtype=int)
+    ch_min = np.full(n_chs, np.inf)
+    ch_max = np.full(n_chs, -np.inf)
+    for start in range(0, raw.n_times, block_size):
+        data = raw.get_data(start=start, stop=start + block_size)
+        n_nan += np.isnan(data).sum(1)
+        n_inf += np.isinf(data).sum(1)
+        finite = np.isfinite(data)
+        ch_min = np.minimum(ch_min, np.where(finite, data, np.inf).min(1))
+        ch_max = np.maximum(ch_max, np.where(finite, data, -np.inf).max(1))
+        del data, finite
+
+    flat = ch_max<=ch_min
+    zero = flat & (ch_max==0)
+    return {ch: {'n_nan': int(n_nan[i]), 'n_inf': int(n_inf[i]),
+                 'flat': bool(flat[i]), 'zero': bool(zero[i])}
+            for i, ch in enumerate(raw.ch_names)}
+
+
+def check_and_fix_channels(raw, preload=True):
+    """check for missing channels or empty channels or NaN channels
+
+    If nothing needs to be fixed, the data is not loaded and `raw` is
+    returned as it is, so it can be written without preloading.
+
+    Parameters
+    ----------
+    raw : the recording, not preloaded
+    preload : where the data is loaded to if channels need to be added.
+              True for memory or a file name to memory-map it to, as the
+              preload of mne.io.read_raw_fif. With a file the channels are
+              appended to it in place and the recording is never held in
+              RAM, otherwise there are briefly two copies while appending.
+    """
     report = {'filename': os.path.basename(raw._filenames[0]),
-              'missing': []}
-    template_info = mne.io.read_info('template-info.fif')
+              'missing': [],
+              'modified': False}
+    template_info = load_template_info()
 
     ch_types = {'BIO001': 'bio',
                 'BIO002': 'bio',
@@ -26,12 +192,11 @@ def check_and_fix_channels(raw):
                 'MEG2211': 'mag',}
 
     # check for missing channels
-    missing = set(template_info.ch_names) - set(raw.ch_names)
+    # in the order of the template, so that the fixed files are reproducible
+    missing = [ch for ch in template_info.ch_names if ch not in raw.ch_names]
     chs_add = []
     bads = raw.info['bads'].copy()
 
-    raw.load_data()
-    empty_ch = np.zeros_like(raw.get_data(0))
     for ch in missing:
         report['missing'] += [ch]
         if ch.startswith('CHPI'):
@@ -39,6 +204,8 @@ def check_and_fix_channels(raw):
             # this file is just fine as it is.
             continue
         elif ch in ch_types:
+            # a read-only view of a single zero, not an array of the full length
+            empty_ch = np.broadcast_to(np.zeros(1), (1, raw.n_times))
             info = mne.create_info(ch_names=[ch], sfreq=raw.info['sfreq'], ch_types=ch_types[ch])
 
             ch_idx = template_info.ch_names.index(ch)
@@ -59,19 +226,23 @@ def check_and_fix_channels(raw):
             raise Exception(f'{ch=} missing! don\'t know what to do')
 
     if chs_add:
-        raw.load_data(verbose='WARNING')
+        if not raw.preload:
+            with mne.use_log_level('WARNING'):
+                raw._preload_data(preload)
         raw.add_channels(chs_add, force_update_info=True)
         if bads:
             raw.info['bads'] += bads
-            raw.interpolate_bads()
-
+            with instrument.stage('interpolate_bads'):
+                interpolate_bads_cached(raw)
+        report['modified'] = True
 
-    # next check if any data is nan
-    data = raw.get_data()
-    for ch, d in zip(raw.ch_names, data):
-        if 'CHPI' in ch:
-            continue
-        assert not np.isnan(d).any(), f'some data is NaN for {ch=}!'
+    # next check if any data is nan, also report infinite and flat channels
+    with instrument.stage('scan_channels'):
+        scan = {ch: res for ch, res in scan_channels(raw).items() if 'CHPI' not in ch}
+    report['inf'] = [ch for ch, res in scan.items() if res['n_inf']]
+    report['flat'] = [ch for ch, res in scan.items() if res['flat']]
+    nan_chs = [ch for ch, res in scan.items() if res['n_nan']]
+    assert not nan_chs, f'some data is NaN for {nan_chs=}!'
     return raw, report
 
 
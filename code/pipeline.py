@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 21:24:18 2026
+
+overlap reading, processing and writing of recordings within one process.
+
+`prefetch` reads the next items in a background thread while the current
+one is processed, `Writer` writes in a background thread while the next
+one is processed. Both are bounded, so that only a fixed number of
+recordings is held in memory at once. Reading and writing FIF files
+mostly waits for IO, during which the GIL is released.
+
+@author: simon.kern
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def prefetch(func, items, n_ahead=1):
+    """like map(func, items), but func is called in a background thread on
+    up to `n_ahead` items ahead of the one that is currently used. Errors
+    are raised when their item is reached. Use with contextlib.closing to
+    stop the thread if the loop is left early"""
+    pool = ThreadPoolExecutor(1, thread_name_prefix='prefetch')
+    futures = deque()
+    try:
+        for item in items:
+            futures.append(pool.submit(func, item))
+            if len(futures)>n_ahead:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+class Writer():
+    """call functions one after another in a background thread.
+
+    `submit` blocks while `max_pending` calls are waiting or running, so
+    at most this many recordings are held for writing. Errors are raised
+    by the next `submit` or by `join`. When the block of the `with`
+    statement raises, calls that didn't start yet are cancelled.
+
+    Parameters
+    ----------
+    max_pending : number of calls that can be waiting or running
+    """
+    def __init__(self, max_pending=1):
+        self.max_pending = max_pending
+        self.pool = ThreadPoolExecutor(1, thread_name_prefix='writer')
+        self.futures = deque()
+
+    def submit(self, func, *args, **kwargs):
+        while len(self.futures)>=self.max_pending:
+            self.futures.popleft().result()
+        self.futures.append(self.pool.submit(func, *args, **kwargs))
+
+    def join(self):
+        """wait until all calls finished, return their results"""
+        results = []
+        while self.futures:
+            results += [self.futures.popleft().result()]
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.join()
+        finally:
+            self.pool.shutdown(wait=True, cancel_futures=True)
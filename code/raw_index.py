@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 16:05:31 2026
+
+index of the raw data folder (data-MEG, data-logs, data-empty-room).
+
+The folder lives on a slow network file system, so it is walked once with
+os.scandir and the listings are cached on disk. On the next run only
+folders whose mtime changed are listed again, all other queries are
+answered from memory.
+
+@author: simon.kern
+"""
+import os
+import re
+import json
+from collections import namedtuple
+
+index_file = os.path.expanduser('~/.cache/fastreplay-MEG-bids/raw_index.json')
+
+# one classified file of the raw data folder
+#   kind: 'meg', 'csv', 'log' or 'emptyroom'
+#   subject: two digit subject id, e.g. '03', None for empty rooms
+#   task: BIDS task name, 'rest1', 'rest2' or 'main', None if unknown
+#   tsss: whether the MEG file was maxfiltered
+#   split: 0 for the first file of a recording, n for the split name-n.fif
+#   date: recording date of an empty room, as in the file name
+RawFile = namedtuple('RawFile', ['path', 'kind', 'subject', 'task', 'tsss', 'split', 'date'])
+
+
+def classify(folder, name):
+    """classify a file by its folder and name, returns a RawFile or None
+    for files that are not part of the conversion"""
+    path = f'{folder}/{name}'
+    parts = folder.strip('/').split('/')
+    match = re.fullmatch(r'mfr[_-](\d+)', parts[-1], flags=re.IGNORECASE)
+    subj_id = f'{int(match.group(1)):02d}' if match else None
+
+    # large recordings are split into name.fif, name-1.fif, name-2.fif, ...
+    split = re.search(r'-(\d+)\.fif$', name)
+    split = int(split.group(1)) if split else 0
+
+    if parts[0]=='data-empty-room' and name.endswith('.fif'):
+        return RawFile(path, 'emptyroom', None, None, False, split, name.split('_')[1])
+
+    if parts[0]=='data-MEG' and subj_id and name.endswith('.fif'):
+        task = None
+        if '_rs1_' in name: task = 'rest1'
+        elif '_rs2_' in name: task = 'rest2'
+        elif '_main_' in name: task = 'main'
+        return RawFile(path, 'meg', subj_id, task, 'tsss' in name, split, None)
+
+    if parts[0]=='data-logs' and subj_id and name.endswith(('.csv', '.log')):
+        task = 'main' if ('main_' in name and name.startswith(subj_id)) else None
+        return RawFile(path, name[-3:], subj_id, task, False, 0, None)
+    return None
+
+
+class RawIndex():
+    """classified files of the raw data folder.
+
+    Parameters
+    ----------
+    root : the raw data folder containing data-MEG, data-logs, data-empty-room
+    index_file : json file in which the folder listings are cached
+    """
+    folders = ['data-MEG', 'data-logs', 'data-empty-room']
+
+    def __init__(self, root, index_file=index_file):
+        self.root = os.path.abspath(root)
+        self.index_file = index_file
+        self.listings = {}
+        if os.path.isfile(index_file):
+            with open(index_file, 'r') as f:
+                cached = json.load(f)
+            if cached['root']==self.root:
+                self.listings = cached['listings']
+        self.refresh()
+
+    def _scan(self, folder, depth, listings):
+        """list `folder` and its subfolders down to `depth`, re-using the
+        cached listing of folders whose mtime didn't change"""
+        try:
+            mtime = os.stat(f'{self.root}/{folder}').st_mtime
+        except FileNotFoundError:
+            return
+        listing = self.listings.get(folder)
+        if listing is None or listing['mtime']!=mtime:
+            files, dirs = [], []
+            with os.scandir(f'{self.root}/{folder}') as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        dirs.append(entry.name)
+                    elif entry.is_file():
+                        files.append(entry.name)
+            listing = {'mtime': mtime, 'files': sorted(files), 'dirs': sorted(dirs)}
+            self.n_listed += 1
+        listings[folder] = listing
+        if depth>0:
+            for name in listing['dirs']:
+                self._scan(f'{folder}/{name}', depth-1, listings)
+
+    def refresh(self):
+        """update the listings of changed folders and re-classify all files"""
+        self.n_listed = 0
+        listings = {}
+        for folder in self.folders:
+            self._scan(folder, 1, listings)
+        if self.n_listed or listings.keys()!=self.listings.keys():
+            os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+            # other conversions might refresh the index at the same time
+            tmp_file = f'{self.index_file}.{os.getpid()}.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump({'root': self.root, 'listings': listings}, f, separators=(',', ':'))
+            os.replace(tmp_file, self.index_file)
+        self.listings = listings
+        self.files = [file for folder, listing in listings.items()
+                      for name in listing['files']
+                      if (file := classify(folder, name))]
+
+    def path(self, file):
+        """absolute path of a RawFile"""
+        return f'{self.root}/{file.path}'
+
+    def subjects(self):
+        """ids of all subjects with MEG data"""
+        return sorted({f.subject for f in self.files if f.kind=='meg'})
+
+    def emptyrooms(self):
+        return [f for f in self.files if f.kind=='emptyroom']
+
+    def query(self, subject=None, **fields):
+        """all files of a subject whose fields match, e.g. kind='meg'"""
+        return [f for f in self.files if (subject is None or f.subject==subject)
+                and all(getattr(f, k)==v for k, v in fields.items())]
+
+    def subject_files(self, subject):
+        """the input files of each conversion step of one subject.
+
+        Returns
+        -------
+        files : dict with the absolute paths of the sources of 'rest1',
+                'rest2', 'main' (the first file first, followed by its
+                splits) and 'beh' (csv and log). Steps for which no
+                unambiguous sources were found are None.
+        problems : list of messages describing missing or ambiguous files
+        """
+        files = {}
+        problems = []
+
+        def select(step, candidates):
+            if len(candidates)==1:
+                return True
+            names = [os.path.basename(f.path) for f in candidates]
+            problems.append(f'{subject} {step}: ambiguous files {names}' if names
+                            else f'{subject} {step}: no files found')
+            files[step] = None
+            return False
+
+        for rs in ['rest1', 'rest2']:
+            fif = self.query(subject, kind='meg', task=rs)
+            if select(rs, fif):
+                files[rs] = [self.path(fif[0])]
+
+        fif = self.query(subject, kind='meg', task='main', tsss=True, split=0)
+        if select('main', fif):
+            # large recordings are split by the acquisition into name.fif, name-1.fif
+            splits = [f for f in self.query(subject, kind='meg', task='main', tsss=True)
+                      if f.path==f'{fif[0].path[:-4]}-{f.split}.fif']
+            files['main'] = [self.path(f) for f in [fif[0]] + sorted(splits, key=lambda f: f.split)]
+
+        csv = self.query(subject, kind='csv', task='main')
+        if select('beh', csv):
+            log = csv[0]._replace(path=csv[0].path[:-3] + 'log', kind='log')
+            if log in self.files:
+                files['beh'] = [self.path(csv[0]), self.path(log)]
+            else:
+                problems.append(f'{subject} beh: {os.path.basename(log.path)} missing')
+                files['beh'] = None
+        return files, problems
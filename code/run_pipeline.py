@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 23:10:36 2026
+
+run the whole conversion as one graph of tasks: the anatomy, defacing,
+recon-all, MEG and behaviour of each subject, the empty rooms and at the
+end the files of the whole dataset (behavioural dataset, checksums).
+
+Each task is one of the existing scripts, restricted to one subject and
+step, with its source files, its outputs and the tasks it depends on.
+Tasks run as soon as their dependencies are done, as many at the same
+time as the pools of CPU cores, IO slots and memory allow, so the MRI
+and the MEG branch run side by side. A task is skipped if its outputs
+exist and neither its sources (including its code), its command nor
+its dependencies changed since it last succeeded. This is kept in a
+Manifest in BIDS_ROOT/.pipeline_manifest.json, so a changed T1 only
+re-runs anat, defacing and recon-all of its subject, never its MEG.
+
+    python code/run_pipeline.py
+    python code/run_pipeline.py --dry-run
+    python code/run_pipeline.py --stages meg beh dataset --subjects 01 02
+
+@author: simon.kern
+"""
+import os
+import sys
+import glob
+import asyncio
+import argparse
+import traceback
+from contextlib import asynccontextmanager
+import psutil
+from manifest import Manifest, code_version
+from raw_index import RawIndex
+from supervisor import Progress, get_logger, run_command
+
+code_dir = os.path.dirname(os.path.abspath(__file__))
+log_dir = os.path.expanduser('~/.cache/fastreplay-MEG-bids/logs/')
+stages = ['anat', 'deface', 'recon', 'emptyroom', 'meg', 'beh', 'dataset']
+
+
+class Task():
+    """one command of the pipeline.
+
+    Parameters
+    ----------
+    key : unique name, e.g. 'meg sub-01'
+    cmd : the shell command
+    sources : input files, including the code that the command runs
+    outputs : output files or glob patterns, each needs to exist afterwards
+    deps : keys of the tasks that need to succeed first
+    resources : dict with the amount of each pool that the task occupies
+    cwd : working directory of the command
+    timeout : seconds after which the command is killed
+    """
+    def __init__(self, key, cmd, sources, outputs, deps=(), resources=None,
+                 cwd=code_dir, timeout=None):
+        self.key = key
+        self.stage = key.split(' ')[0]
+        self.cmd = cmd
+        self.sources = sources
+        self.outputs = outputs
+        self.deps = list(deps)
+        self.resources = resources or {'cpu': 1}
+        self.cwd = cwd
+        self.timeout = timeout
+
+
+class Resources():
+    """pools (e.g. CPU cores, IO slots, GB of memory) shared by all tasks.
+    A task waits until everything it needs is free at once. Requests larger
+    than a pool are reduced to its size, so that the task can run alone"""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.free = dict(capacity)
+        self.condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def acquire(self, request):
+        request = {name: min(amount, self.capacity[name]) for name, amount in request.items()}
+        async with self.condition:
+            await self.condition.wait_for(
+                lambda: all(self.free[name]>=amount for name, amount in request.items()))
+            for name, amount in request.items():
+                self.free[name] -= amount
+        try:
+            yield
+        finally:
+            async with self.condition:
+                for name, amount in request.items():
+                    self.free[name] += amount
+                self.condition.notify_all()
+
+
+def get_tasks(bids_root, raw_folder, mri_folder, subjects=None, dcm2niix='dcm2niix'):
+    """the tasks of all subjects that have sources, the longest first.
+
+    Parameters
+    ----------
+    bids_root : the BIDS root
+    raw_folder : folder with data-MEG, data-logs and data-empty-room
+    mri_folder : folder with data-MRI/MFRXX, recon-all writes to its freesurfer/
+    subjects : ids of the subjects, e.g. ['01', '02'], default: all that are found
+    dcm2niix : path to the dcm2niix executable
+    """
+    py = sys.executable
+    code = lambda *names: [f'{code_dir}/{name}' for name in names]
+    raw_index = RawIndex(raw_folder)
+    subjects_mri = [os.path.basename(folder)[3:] for folder in glob.glob(f'{mri_folder}/data-MRI/MFR*')]
+    subjects = sorted(set(raw_index.subjects() + subjects_mri) if subjects is None else subjects)
+    convert = f'{py} {code_dir}/convert_to_bids.py --raw-folder {raw_folder} --bids-root {bids_root}'
+    # recordings that need fixing are checked against it
+    template = [f for f in [f'{bids_root}/template-info.fif'] if os.path.isfile(f)]
+
+    tasks_mri, tasks_meg = [], []
+    sources_er = [raw_index.path(f) for f in raw_index.emptyrooms()]
+    if sources_er:
+        tasks_meg += [Task('emptyroom', f'{convert} --steps emptyroom',
+                           sources_er + code('convert_to_bids.py'), [f'{bids_root}/sub-emptyroom'],
+                           resources={'cpu': 2, 'io': 1}, cwd=bids_root)]
+
+    for subj in subjects:
+        dicoms = sorted(glob.glob(f'{mri_folder}/data-MRI/MFR{subj}/*IMA'))
+        if dicoms:
+            anat = f'{bids_root}/sub-{subj}/anat/sub-{subj}_T1w'
+            tasks_mri += [
+                Task(f'recon sub-{subj}',
+                     f'{py} run_recon_all.py --project-dir {mri_folder} --subjects {subj}',
+                     dicoms + code('run_recon_all.py'),
+                     [f'{mri_folder}/freesurfer/MFR{subj}/surf/{hemi}.white' for hemi in ['lh', 'rh']],
+                     resources={'cpu': 4, 'mem': 4}),
+                Task(f'anat sub-{subj}',
+                     f'{py} convert_anat.py --dicom-root {mri_folder}/data-MRI/ --bids-root {bids_root} '
+                     f'--subjects {subj} --dcm2niix {dcm2niix} --n-jobs 1',
+                     dicoms + code('convert_anat.py', 'heudiconv_heuristic.py'),
+                     # the _orig is replaced by the defaced T1w
+                     [f'{anat}*.nii.gz'], resources={'cpu': 1, 'io': 1}),
+                Task(f'deface sub-{subj}', f'sh defacing.sh {bids_root} sub-{subj}',
+                     code('defacing.sh'), [f'{anat}.nii.gz'], deps=[f'anat sub-{subj}'],
+                     resources={'cpu': 1, 'mem': 2})]
+
+        files, problems = raw_index.subject_files(subj)
+        for problem in problems:
+            print(f'WARNING: {problem}, skipping')
+        tasks = [task for task in ['rest1', 'rest2', 'main'] if files.get(task)]
+        if tasks:
+            # about the peak memory of converting one subject, as in convert_to_bids.py
+            tasks_meg += [Task(f'meg sub-{subj}', f'{convert} --steps meg --subjects {subj}',
+                               [f for task in tasks for f in files[task]] + template
+                               + code('convert_to_bids.py', 'misc.py'),
+                               [f'{bids_root}/sub-{subj}/meg/sub-{subj}_task-{task}*_meg.fif'
+                                for task in tasks],
+                               deps=['emptyroom'] if sources_er else [],
+                               resources={'cpu': 2, 'io': 1, 'mem': 12}, cwd=bids_root)]
+        if files.get('beh'):
+            # the behaviour is aligned to the triggers of the main task
+            tasks_meg += [Task(f'beh sub-{subj}', f'{convert} --steps beh --subjects {subj}',
+                               files['beh'] + (files.get('main') or [])
+                               + code('convert_to_bids.py', 'events_conversion.py', 'alignment.py', 'misc.py'),
+                               [f'{bids_root}/sub-{subj}/beh/sub-{subj}_task-main_beh.tsv'],
+                               resources={'cpu': 1}, cwd=bids_root)]
+
+    # everything that the checksums cover needs to be done first. recon-all
+    # writes outside of the BIDS root, so the dataset doesn't wait for it
+    tasks = tasks_mri + tasks_meg
+    deps = [task.key for task in tasks if not task.key.startswith('recon ')]
+    tasks += [Task('dataset', f'{convert} --steps dataset', code('beh_dataset.py', 'checksums.py'),
+                   [f'{bids_root}/checksums.json'], deps=deps,
+                   resources={'cpu': 1, 'io': 1}, cwd=bids_root)]
+    return tasks
+
+
+def get_version(task, manifest):
+    """version stamp of the command and of the sources and versions that
+    the dependencies last succeeded with"""
+    deps = [(dep, entry['version'], sorted((f, sig['sha1']) for f, sig in entry['sources'].items()))
+            for dep in task.deps if (entry := manifest.entries.get(dep))]
+    return code_version(task.cmd, deps)
+
+
+async def run_task(task, manifest, resources, progress, force=False, dry_run=False):
+    """run a task if it is out of date.
+
+    Returns
+    -------
+    'skipped', 'done' or 'stale' for a dry run, raises if the task failed
+    """
+    version = get_version(task, manifest)
+    # hashing large sources would block the other tasks
+    up_to_date = await asyncio.to_thread(manifest.is_up_to_date, task.key, task.sources,
+                                         task.outputs, version)
+    if up_to_date and not force:
+        return 'skipped'
+    if dry_run:
+        print(f'{task.key} is out of date: {task.cmd}')
+        return 'stale'
+
+    logger = get_logger(task.key, f'{log_dir}/pipeline-{task.key.replace(" ", "_")}.log')
+    async with resources.acquire(task.resources):
+        progress.update_step(task.key, 'running')
+        returncode = await run_command(task.cmd, logger, timeout=task.timeout, cwd=task.cwd)
+    if returncode!=0:
+        raise RuntimeError(f'{task.key} exited with {returncode}, see {logger.handlers[0].baseFilename}')
+    missing = [output for output in task.outputs if not glob.glob(output)]
+    if missing:
+        raise RuntimeError(f'{task.key} did not create {missing}')
+    entry = await asyncio.to_thread(manifest.make_entry, task.key, task.sources, version)
+    manifest.update(task.key, entry)
+    manifest.save()
+    return 'done'
+
+
+async def run_all(tasks, manifest, resources, force=False, dry_run=False):
+    """run all tasks, each as soon as its dependencies succeeded.
+    Dependencies that are not part of `tasks` count as done.
+
+    Returns
+    -------
+    dict with the state of each task: 'skipped', 'done', 'stale' (dry run),
+    'failed' or 'blocked' (a dependency failed) and the errors of failed tasks
+    """
+    finished = {task.key: asyncio.Event() for task in tasks}
+    states, errors = {}, {}
+    progress = Progress(len(tasks), desc='pipeline')
+
+    async def run(task):
+        try:
+            deps = [dep for dep in task.deps if dep in finished]
+            for dep in deps:
+                await finished[dep].wait()
+            if any(states[dep] in ['failed', 'blocked'] for dep in deps):
+                states[task.key] = 'blocked'
+            elif dry_run and any(states[dep]=='stale' for dep in deps):
+                print(f'{task.key} is out of date, a dependency is: {task.cmd}')
+                states[task.key] = 'stale'
+            else:
+                states[task.key] = await run_task(task, manifest, resources, progress,
+                                                  force=force, dry_run=dry_run)
+        except Exception:
+            states[task.key] = 'failed'
+            errors[task.key] = traceback.format_exc()
+        finally:
+            finished[task.key].set()
+            progress.finish(task.key)
+
+    await asyncio.gather(*[run(task) for task in tasks])
+    progress.close()
+    return states, errors
+
+
+if __name__=='__main__':
+    bids_root = os.path.abspath(f'{code_dir}/../')
+    parser = argparse.ArgumentParser(description='run all conversion steps that are out of date')
+    parser.add_argument('--bids-root', default=bids_root)
+    parser.add_argument('--raw-folder',
+                        default='/zi/flstorage/group_klips/data/data/Simon/highspeed/highspeed-MEG-raw/',
+                        help='folder with data-MEG, data-logs and data-empty-room')
+    parser.add_argument('--mri-folder', default=f'{bids_root}/../Fast-Replay-MEG/',
+                        help='folder with data-MRI/MFRXX, recon-all writes to its freesurfer/')
+    parser.add_argument('--dcm2niix', default=f'{code_dir}/dcm2niix',
+                        help='path to the dcm2niix executable')
+    parser.add_argument('--subjects', nargs='+', default=None,
+                        help='only these subjects, e.g. 01 02, default: all')
+    parser.add_argument('--stages', nargs='+', choices=stages, default=stages,
+                        help='only these stages, the others count as done')
+    parser.add_argument('--force', action='store_true', help='also run tasks that are up to date')
+    parser.add_argument('--dry-run', action='store_true', help='only print what is out of date')
+    parser.add_argument('--n-cpu', type=int, default=os.cpu_count(), help='CPU cores to use')
+    parser.add_argument('--n-io', type=int, default=4,
+                        help='tasks that read from the network storage at the same time')
+    parser.add_argument('--mem', type=float, default=psutil.virtual_memory().available / 1024**3,
+                        help='GB of memory to use, default: all that is available')
+    args = parser.parse_args()
+
+    bids_root = os.path.abspath(args.bids_root)
+    tasks = get_tasks(bids_root, os.path.abspath(args.raw_folder), os.path.abspath(args.mri_folder),
+                      args.subjects, dcm2niix=args.dcm2niix)
+    tasks = [task for task in tasks if task.stage in args.stages]
+    os.makedirs(log_dir, exist_ok=True)
+    manifest = Manifest(f'{bids_root}/.pipeline_manifest.json')
+    resources = Resources({'cpu': args.n_cpu, 'io': args.n_io, 'mem': args.mem})
+    print(f'{len(tasks)} tasks, {resources.capacity=}')
+
+    states, errors = asyncio.run(run_all(tasks, manifest, resources, force=args.force,
+                                         dry_run=args.dry_run))
+    for key, error in errors.items():
+        print('#'*40, key)
+        print(error)
+    for state in ['done', 'skipped', 'stale', 'failed', 'blocked']:
+        keys = [key for key in states if states[key]==state]
+        if keys:
+            print(f'{state:>8}: {len(keys)} {keys if state in ["failed", "blocked"] else ""}')
+    sys.exit(1 if errors else 0)
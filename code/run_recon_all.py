@@ -6,21 +6,100 @@ Created on Mon Oct 21 15:56:57 2024
 @author: simon.kern
 """
 import os
+import sys
+import json
 import time
-import subprocess
-from subprocess import PIPE
-from tqdm import tqdm
-from joblib import Parallel, delayed
+import glob
+import shutil
+import asyncio
+import argparse
+import threading
+import traceback
+import psutil
+from manifest import file_lock
+from supervisor import Progress, get_logger, recon_all_step, run_command
 
-def recon_all(folder):
+mem_per_job = 4  # GB, approximate peak memory of one recon-all run
+max_threads_per_job = 4  # more threads than this barely speed up recon-all
+timeouts = {'dcm2niix': 30*60, 'recon-all': 48*3600}  # seconds per step
+
+
+class ReconState():
+    """persistent state (queued/running/done/failed) of each subject,
+    stored as json so that a crashed run can be resumed"""
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.lock = threading.Lock()
+        self.states = self.load()
+
+    def load(self):
+        if not os.path.isfile(self.state_file):
+            return {}
+        with open(self.state_file, 'r') as f:
+            return json.load(f)
+
+    def set(self, subj, state, **info):
+        """set the state of `subj`, keeping the states that other
+        processes saved in the meantime"""
+        with self.lock, file_lock(self.state_file):
+            self.states = self.load()
+            self.states[subj] = {'state': state, 'time': time.ctime()} | info
+            tmp_file = f'{self.state_file}.{os.getpid()}.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(self.states, f, indent=1)
+            os.replace(tmp_file, self.state_file)
+
+
+def is_reconstructed(subj_dir, subj):
+    return os.path.exists(f'{subj_dir}/{subj}/surf/lh.white') and \
+        os.path.exists(f'{subj_dir}/{subj}/surf/rh.white')
+
+
+def is_started(subj_dir, subj):
+    """recon-all already imported the T1 for this subject, so it can be
+    continued with `-make all` instead of starting from scratch"""
+    return os.path.exists(f'{subj_dir}/{subj}/mri/orig/001.mgz')
+
+
+def folder_size(folder):
+    return sum(os.path.getsize(f) for f in glob.glob(f'{folder}/**', recursive=True)
+               if os.path.isfile(f))
+
+
+def get_resources(n_folders, mem_per_job=mem_per_job, max_threads_per_job=max_threads_per_job):
+    """number of parallel jobs and threads per job that fit into the
+    available CPU cores and memory"""
+    n_cores = os.cpu_count()
+    mem_available = psutil.virtual_memory().available / 1024**3
+    n_jobs = max(1, min(n_folders, n_cores, int(mem_available // mem_per_job)))
+    n_threads = max(1, min(max_threads_per_job, n_cores // n_jobs))
+    return n_jobs, n_threads
+
+
+async def recon_all(folder, subj_dir, n_threads, semaphore, state, progress):
     MRI_FOLDER = folder
     SUBJ = os.path.basename(MRI_FOLDER)
+    async with semaphore:
+        try:
+            return await _recon_all(MRI_FOLDER, SUBJ, subj_dir, n_threads, state, progress)
+        except Exception:
+            print('#'*40, MRI_FOLDER)
+            print(traceback.format_exc())
+            state.set(SUBJ, 'failed', error=traceback.format_exc())
+            return f'{SUBJ} : Error {traceback.format_exc()}'
+        finally:
+            progress.finish(SUBJ)
+
 
-    if os.path.exists(f'{subj_dir}/{SUBJ}/surf/lh.white') and \
-        os.path.exists(f'{subj_dir}/{SUBJ}/surf/rh.white'):
+async def _recon_all(MRI_FOLDER, SUBJ, subj_dir, n_threads, state, progress):
+    if is_reconstructed(subj_dir, SUBJ):
         print(f'already reconstructed for {SUBJ}')
+        state.set(SUBJ, 'done')
         return
 
+    state.set(SUBJ, 'running', n_threads=n_threads)
+    log_dir = f'{subj_dir}/logs/'
+    logger = get_logger(SUBJ, f'{log_dir}/{SUBJ}.log')
     os.environ['FSLOUTPUTTYPE'] = 'NIFTI_GZ'
     MRI_FOLDER = MRI_FOLDER.replace('//', '/')
     assert os.path.isdir(MRI_FOLDER)
@@ -29,45 +108,91 @@ def recon_all(folder):
 
     # first convert the DICOM to NIFGI
     if not os.path.exists(NIFTI_FILE):
+        progress.update_step(SUBJ, 'dcm2niix')
         convert_cmd = f'./dcm2niix -d n {MRI_FOLDER}'
-        process = subprocess.Popen(convert_cmd, stdout=PIPE, stderr=PIPE, shell=True)
-        while process.stdout.readable():
-            line = process.stdout.readline()
-            if not line: break
-            print(line.decode().strip())
-            time.sleep(0.05)
+        await run_command(convert_cmd, logger, timeout=timeouts['dcm2niix'])
         t1_files = list(filter(lambda x:(x.endswith('gz') and 't1' in x.lower()), os.listdir(MRI_FOLDER)))
-        if len(t1_files)==0: return
+        if len(t1_files)==0:
+            state.set(SUBJ, 'failed', error='no T1 found')
+            return
         os.rename(f'{MRI_FOLDER}/{t1_files[0]}', NIFTI_FILE)
-    try:
-        # now extract the regions
+
+    # continue partially reconstructed subjects instead of starting over
+    if is_started(subj_dir, SUBJ):
+        for file in glob.glob(f'{subj_dir}/{SUBJ}/scripts/IsRunning.*'):
+            os.remove(file)  # left over if recon-all was killed
+        recon_cmd = f'nice -n 15 recon-all -s {SUBJ} -make all'
+    else:
+        if os.path.isdir(f'{subj_dir}/{SUBJ}'):
+            shutil.rmtree(f'{subj_dir}/{SUBJ}')  # import didn't finish
         recon_cmd = f'nice -n 15 recon-all -i {NIFTI_FILE} -s {SUBJ}  -all'
-        process = subprocess.Popen(recon_cmd, stdout=PIPE, stderr=PIPE, shell=True)
-        lines = [f'{SUBJ}: ']
-        while process.stdout.readable():
-            line = process.stdout.readline().decode()
-            if not line: break
-            lines.append(line)
-            print(line.strip())
-    except Exception as e:
-        print('#'*40, MRI_FOLDER)
-        import traceback
-        print(traceback.format_exc())
-        return f'{SUBJ} : Error {traceback.format_exc()}'
-
-    return '\n'.join(lines)
+    if n_threads>1:
+        recon_cmd += f' -parallel -openmp {n_threads}'
+
+    # now extract the regions
+    def on_line(line):
+        if step := recon_all_step(line):
+            progress.update_step(SUBJ, step)
+    progress.update_step(SUBJ, 'recon-all')
+    returncode = await run_command(recon_cmd, logger, timeout=timeouts['recon-all'],
+                                   on_line=on_line)
+
+    if returncode==0 and is_reconstructed(subj_dir, SUBJ):
+        state.set(SUBJ, 'done')
+    else:
+        state.set(SUBJ, 'failed', error=f'recon-all exited with {returncode}, see {log_dir}/{SUBJ}.log')
+    return f'{SUBJ}: exited with {returncode}'
+
+
+async def run_all(folders, subj_dir, n_jobs, n_threads, state, progress):
+    semaphore = asyncio.Semaphore(n_jobs)
+    return await asyncio.gather(*[recon_all(folder, subj_dir, n_threads, semaphore, state, progress)
+                                  for folder in folders])
 
 project_dir = '/zi/flstorage/group_klips/data/data/Fast-Replay-MEG/'
-subj_dir = f'{project_dir}/freesurfer/'
-folders = [f'{project_dir}/data-MRI/{x}' for x in os.listdir(project_dir + 'data-MRI')]
-folders = [f for f in folders if os.path.isdir(f)]
-FS_HOME = os.environ.get('FREESURFER_HOME')
-os.makedirs(subj_dir, exist_ok=True)
-os.environ['SUBJECTS_DIR'] = subj_dir
 
 
-assert FS_HOME, '$FREESURFER_HOME not found in env'
-assert os.path.isfile(FS_HOME + '/bin/recon-all'), 'recon-all not found'
-assert FS_HOME in os.environ['PATH'], 'freesurfer not on $PATH'
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='run recon-all for all subjects')
+    parser.add_argument('--project-dir', default=project_dir,
+                        help='folder with data-MRI/MFRXX, freesurfer/ is created in it')
+    parser.add_argument('--subjects', nargs='+', default=None,
+                        help='only reconstruct these subjects, e.g. 01 02, default: all')
+    args = parser.parse_args(argv)
+
+    subj_dir = f'{args.project_dir}/freesurfer/'
+    log_dir = f'{subj_dir}/logs/'
+    folders = [f'{args.project_dir}/data-MRI/{x}' for x in os.listdir(f'{args.project_dir}/data-MRI')]
+    folders = [f for f in folders if os.path.isdir(f)]
+    if args.subjects is not None:
+        folders = [f for f in folders if os.path.basename(f)[3:] in args.subjects]
+    FS_HOME = os.environ.get('FREESURFER_HOME')
+    os.makedirs(subj_dir, exist_ok=True)
+    os.makedirs(log_dir, exist_ok=True)
+    os.environ['SUBJECTS_DIR'] = subj_dir
+
+    assert FS_HOME, '$FREESURFER_HOME not found in env'
+    assert os.path.isfile(FS_HOME + '/bin/recon-all'), 'recon-all not found'
+    assert FS_HOME in os.environ['PATH'], 'freesurfer not on $PATH'
+
+    # subjects that were 'running' when a previous run crashed are simply
+    # queued again, recon_all() picks up where they stopped
+    state = ReconState(f'{subj_dir}/recon_state.json')
+    for folder in folders:
+        SUBJ = os.path.basename(folder)
+        state.set(SUBJ, 'done' if is_reconstructed(subj_dir, SUBJ) else 'queued')
+    subjects = [os.path.basename(f) for f in folders]
+    folders = [f for f in folders if state.states[os.path.basename(f)]['state']=='queued']
+
+    # largest first, so the longest jobs don't end up running alone at the end
+    folders = sorted(folders, key=folder_size, reverse=True)
+    n_jobs, n_threads = get_resources(len(folders))
+    print(f'running recon-all for {len(folders)} subjects with {n_jobs=} and {n_threads=}')
+    progress = Progress(len(folders), desc='recon-all')
+    errs_recon = asyncio.run(run_all(folders, subj_dir, n_jobs, n_threads, state, progress))
+    progress.close()
+    return int(any(state.states[subj]['state']=='failed' for subj in subjects))
+
 
-errs_recon = Parallel(30, backend='threading')(delayed(recon_all)(folder) for folder in tqdm(folders))
+if __name__=='__main__':
+    sys.exit(main())
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 16:48:12 2026
+
+build BIDS outputs on fast local scratch and publish them to the BIDS root
+on the network storage in one go.
+
+Each subject is written into its own staging folder. When it is done, each
+of its datatype folders (e.g. sub-01/meg) is assembled next to the
+published one (unchanged files are hard linked) and swapped in with two
+renames (old out, new in). This is near-atomic: readers never see a half
+written folder, but between the two renames the folder briefly doesn't
+exist. The shared participants.tsv is merged once at the end.
+
+@author: simon.kern
+"""
+import os
+import glob
+import shutil
+import tempfile
+import pandas as pd
+from manifest import file_lock
+
+
+def read_tsv(tsv_file):
+    """read a BIDS tsv as strings, keeping 'n/a' as is"""
+    return pd.read_csv(tsv_file, sep='\t', dtype=str, keep_default_na=False,
+                       encoding='utf-8-sig')
+
+
+def write_tsv(df, tsv_file):
+    """write a BIDS tsv atomically, in the same format as mne_bids"""
+    tmp_file = f'{os.path.dirname(tsv_file)}/.{os.path.basename(tsv_file)}.tmp'
+    df.to_csv(tmp_file, sep='\t', index=False, na_rep='n/a', encoding='utf-8-sig')
+    os.replace(tmp_file, tsv_file)
+
+
+def merge_tsv(dfs, key):
+    """concatenate tables, later rows replace earlier rows with the same key"""
+    df = pd.concat(dfs, ignore_index=True).fillna('n/a')
+    return df.drop_duplicates(key, keep='last').sort_values(key, ignore_index=True)
+
+
+def link_or_copy(src, dst):
+    """hard link a file, copy it if the file system doesn't support links"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class Staging():
+    """stage BIDS outputs on local scratch and publish them to `bids_root`.
+
+    Parameters
+    ----------
+    bids_root : the BIDS root to publish to
+    scratch_dir : fast local folder in which the staging folders are created
+    """
+    def __init__(self, bids_root, scratch_dir=None):
+        self.bids_root = os.path.abspath(bids_root)
+        self.scratch_dir = scratch_dir or tempfile.gettempdir()
+        self.participants = []
+
+    def new_root(self, name):
+        """create a new staging folder, can be called in a worker process"""
+        os.makedirs(self.scratch_dir, exist_ok=True)
+        return tempfile.mkdtemp(prefix=f'{name}-', dir=self.scratch_dir)
+
+    def staged(self, bids_path, stage_root):
+        """the same BIDSPath, but inside the staging folder"""
+        rel = os.path.relpath(bids_path.root, self.bids_root)
+        return bids_path.copy().update(root=os.path.normpath(f'{stage_root}/{rel}'))
+
+    def discard(self, stage_root):
+        shutil.rmtree(stage_root, ignore_errors=True)
+
+    def publish(self, stage_root):
+        """move everything of a staging folder to the BIDS root"""
+        self._publish(stage_root, '')
+        self.discard(stage_root)
+
+    def _publish(self, stage_root, rel):
+        for entry in sorted(os.scandir(f'{stage_root}/{rel}'), key=lambda e: e.name):
+            rel_entry = f'{rel}{entry.name}'
+            if entry.is_dir() and entry.name.startswith('sub-'):
+                self._publish_subject(stage_root, rel_entry)
+            elif entry.is_dir():
+                self._publish(stage_root, f'{rel_entry}/')
+            elif rel_entry=='participants.tsv':
+                self.participants.append(read_tsv(entry.path))
+            elif not os.path.exists(f'{self.bids_root}/{rel_entry}'):
+                # e.g. README or participants.json, never overwrite these
+                os.makedirs(os.path.dirname(f'{self.bids_root}/{rel_entry}'), exist_ok=True)
+                shutil.copy2(entry.path, f'{self.bids_root}/{rel_entry}')
+
+    def _publish_subject(self, stage_root, rel):
+        """publish the folders and files of a subject. Folders that are not
+        staged are not touched, e.g. anat/, which convert_anat.py writes to
+        directly. Conversions that publish the same subject take turns"""
+        src = f'{stage_root}/{rel}'
+        dst = f'{self.bids_root}/{rel}'
+        os.makedirs(dst, exist_ok=True)
+        with file_lock(dst):
+            for entry in sorted(os.scandir(src), key=lambda e: e.name):
+                if entry.is_dir():
+                    self._swap_folder(entry.path, f'{dst}/{entry.name}')
+                else:
+                    self._publish_file(entry.path, f'{dst}/{entry.name}')
+
+    def _publish_file(self, file, target):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if file.endswith('_scans.tsv') and os.path.isfile(target):
+            # only contains the recordings written in this run
+            write_tsv(merge_tsv([read_tsv(target), read_tsv(file)], 'filename'), target)
+            return
+        if os.path.exists(target):
+            os.remove(target)  # a hard link to the published file
+        shutil.copy2(file, target)
+
+    def _swap_folder(self, src, dst):
+        """assemble the new folder next to the published one and swap it in.
+        Near-atomic: between the two renames `dst` briefly doesn't exist"""
+        new = f'{os.path.dirname(dst)}/.{os.path.basename(dst)}.staging-{os.getpid()}'
+        old = f'{os.path.dirname(dst)}/.{os.path.basename(dst)}.old-{os.getpid()}'
+        shutil.rmtree(new, ignore_errors=True)
+        if os.path.isdir(dst):
+            shutil.copytree(dst, new, symlinks=True, copy_function=link_or_copy)
+        else:
+            os.makedirs(new)
+
+        for file in glob.glob(f'{src}/**', recursive=True):
+            if os.path.isfile(file):
+                self._publish_file(file, f'{new}/{os.path.relpath(file, src)}')
+
+        if os.path.isdir(dst):
+            os.rename(dst, old)
+        os.rename(new, dst)
+        shutil.rmtree(old, ignore_errors=True)
+
+    def finish(self):
+        """merge the participants of all published subjects into the
+        participants.tsv of the BIDS root, other conversions might be
+        merging theirs at the same time"""
+        if not self.participants:
+            return
+        tsv_file = f'{self.bids_root}/participants.tsv'
+        with file_lock(tsv_file):
+            dfs = [read_tsv(tsv_file)] if os.path.isfile(tsv_file) else []
+            write_tsv(merge_tsv(dfs + self.participants, 'participant_id'), tsv_file)
+        self.participants = []
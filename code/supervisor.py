@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 14:02:17 2026
+
+run external tools (dcm2niix, recon-all) as asyncio subprocesses. stdout
+and stderr are drained at the same time, so a chatty stderr can't fill its
+pipe and block the process, and many processes can be supervised from a
+single thread.
+
+@author: simon.kern
+"""
+import os
+import re
+import signal
+import asyncio
+import logging
+from logging.handlers import RotatingFileHandler
+from tqdm import tqdm
+
+
+class Progress():
+    """one progress bar for all jobs, showing the current step of each
+    running job next to it"""
+    def __init__(self, total, desc='processing'):
+        self.pbar = tqdm(total=total, desc=desc)
+        self.steps = {}
+
+    def update_step(self, name, step):
+        self.steps[name] = step
+        self.pbar.set_postfix_str(' | '.join(f'{k}: {v}' for k, v in self.steps.items()))
+
+    def finish(self, name):
+        self.steps.pop(name, None)
+        self.pbar.update(1)
+        self.pbar.set_postfix_str(' | '.join(f'{k}: {v}' for k, v in self.steps.items()))
+
+    def close(self):
+        self.pbar.close()
+
+
+def get_logger(name, log_file, max_bytes=10*1024**2, backup_count=3):
+    """logger that writes to a rotating log file for one job"""
+    logger = logging.getLogger(f'supervisor.{name}')
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    if not logger.handlers:
+        handler = RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        logger.addHandler(handler)
+    return logger
+
+
+def recon_all_step(line):
+    """name of the recon-all step if the line announces a new one, e.g.
+    '#@# Talairach Tue Oct 22 10:00:00 CEST 2024' -> 'Talairach'"""
+    match = re.match(r'#@# (.+?) (Mon|Tue|Wed|Thu|Fri|Sat|Sun) ', line)
+    return match.group(1) if match else None
+
+
+async def run_command(cmd, logger, timeout=None, on_line=None, cwd=None):
+    """run a shell command and log stdout and stderr while it runs.
+
+    Parameters
+    ----------
+    cmd : the command to run
+    logger : logger that receives every line of output, see `get_logger`
+    timeout : seconds after which the process is killed, None for no limit
+    on_line : optional function that is called with each stdout line
+    cwd : working directory of the process, default: the current one
+
+    Returns
+    -------
+    returncode of the process, raises asyncio.TimeoutError on timeout
+    """
+    logger.info(f'$ {cmd}')
+    process = await asyncio.create_subprocess_shell(
+        cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        limit=2**20, start_new_session=True, cwd=cwd)
+
+    async def drain(stream, is_stderr):
+        async for line in stream:
+            line = line.decode(errors='replace').rstrip()
+            logger.info(f'[stderr] {line}' if is_stderr else line)
+            if on_line is not None and not is_stderr:
+                on_line(line)
+
+    try:
+        await asyncio.wait_for(asyncio.gather(drain(process.stdout, False),
+                                              drain(process.stderr, True),
+                                              process.wait()), timeout)
+    except asyncio.TimeoutError:
+        logger.info(f'timeout after {timeout} seconds, killing process')
+        # kill the whole process group, the shell might have started children
+        os.killpg(process.pid, signal.SIGKILL)
+        await process.wait()
+        raise
+    logger.info(f'exited with {process.returncode}')
+    return process.returncode
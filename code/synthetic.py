@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 20:11:05 2026
+
+synthetic inputs with the structure of the raw data, for benchmarks and
+for trying out the conversion without access to the raw data.
+
+- PsychoPy runs (csv and log) with the localizer, sequence and question
+  routines that convert_psychopy_to_bids expects
+- FIF recordings with the channels of template-info.fif, triggers on
+  STI101 and some of the channels removed
+- a raw data folder (data-MEG, data-logs, data-empty-room) of several
+  subjects, in which the MEG triggers match the behaviour
+
+@author: simon.kern
+"""
+import os
+import numpy as np
+import pandas as pd
+import mne
+from mne.io.constants import FIFF
+import events_conversion
+import alignment
+
+# names of the stimulus images as in the psychopy log
+stimuli = [stim.capitalize() for stim in events_conversion.stimuli]
+meas_date = 1700000000  # 2023-11-14, recording date of the first subject
+
+
+def make_psychopy_run(basename, n_localizer=40, n_sequence=15, seed=0):
+    """write a psychopy run (basename.csv and basename.log).
+
+    Parameters
+    ----------
+    basename : file name without extension
+    n_localizer : number of localizer trials
+    n_sequence : number of sequence trials, each with cue, five images
+                 and a question
+    seed : seed of the random trial order, responses and timing jitter
+
+    Returns
+    -------
+    name of the csv file
+    """
+    rng = np.random.default_rng(seed)
+    rows, log = [], []
+    t = 1.0
+
+    def routine(duration):
+        nonlocal t
+        start = round(t + rng.random()*1e-5, 6)
+        t = start + duration
+        return start, round(t, 6)
+
+    def set_prop(time, component, prop, value):
+        log.append((round(time, 4), f'{component}: {prop} = {value}'))
+
+    start, stop = routine(3.0)
+    rows.append({'language_selection_screen.started': start,
+                 'language_selection_screen.stopped': stop, 'choice_key.keys': 'g'})
+    for name in ['instruct_pre1', 'instruct_pre2']:
+        start, stop = routine(2.0)
+        rows.append({f'{name}.started': start, f'{name}.stopped': stop})
+
+    for i in range(n_localizer):
+        row = {'localizer.started': t, 'trials.thisN': i}
+        start, stop = routine(0.5)
+        row |= {'localizer_img.started': start, 'localizer_img.stopped': stop}
+        set_prop(start, 'localizer_img', 'ori', rng.choice(['0', '180'], p=[0.8, 0.2]))
+        set_prop(start, 'localizer_img', 'image', f"'stimuli/{stimuli[rng.integers(5)]}.png'")
+        if rng.random()<0.5:
+            row |= {'key_resp_localizer.rt': round(rng.random(), 4),
+                    'key_resp_localizer.keys': 'space'}
+        start, stop = routine(1.0)
+        row |= {'localizer_isi.started': start, 'localizer_isi.stopped': stop}
+        if rng.random()<0.3:
+            start, stop = routine(0.3)
+            row |= {'loc_feedback.started': start, 'loc_feedback.stopped': stop}
+            set_prop(start, 'loc_feedback', 'foreColor', rng.choice(['red', 'green']))
+        rows.append(row)
+
+    start, stop = routine(10)
+    rows.append({'buffer_2.started': start, 'buffer_2.stopped': stop})
+    for i in range(n_sequence):
+        row = {'sequence.started': t, 'trials_2.thisN': i}
+        sequence = list(rng.permutation(stimuli))
+        cue = sequence[rng.integers(5)]
+        start, stop = routine(1.0)
+        row |= {'cue.started': start, 'cue.stopped': stop, 'cue_text.started': start}
+        set_prop(start, 'cue_text', 'text', f"'{cue}'")
+        start, stop = routine(1.5)
+        row |= {'blank1500.started': start, 'blank1500.stopped': stop}
+        start, stop = routine(0.5)
+        row |= {'fixation_dot.started': start, 'fixation_dot.stopped': stop}
+        isi = [0.032, 0.064, 0.128, 0.512][rng.integers(4)]
+        first = None
+        for k in range(1, 6):
+            start, stop = routine(0.1)
+            row |= {f'sequence_img_{k}.started': start, f'sequence_img_{k}.stopped': stop}
+            first = start if first is None else first
+            start, stop = routine(isi)
+            row |= {f'sequence_isi_{k}.started': start, f'sequence_isi_{k}.stopped': stop}
+        # psychopy sets all images of the sequence when it starts
+        for k in range(1, 6):
+            set_prop(first, f'sequence_img_{k}', 'image', f"'stimuli/{sequence[k-1]}.png'")
+        start, stop = routine(2.0)
+        row |= {'buffer_fixation.started': start, 'buffer_fixation.stopped': stop}
+
+        start, stop = routine(1.5)
+        row |= {'question.started': start, 'question.stopped': stop,
+                'question_text.started': start}
+        correct = sequence.index(cue) + 1
+        other = int(rng.choice([pos for pos in range(1, 6) if pos!=correct]))
+        choices = [correct, other] if rng.random()<.5 else [other, correct]
+        set_prop(start, 'question_text', 'text', f"'Position?\\\\n{choices[0]} ? {choices[1]}'")
+        if rng.random()<0.9:
+            row |= {'question_key_resp.keys': rng.choice(['g', 'r']),
+                    'question_key_resp.rt': round(rng.random(), 4)}
+        start, stop = routine(0.5)
+        row |= {'feedback.started': start, 'feedback.stopped': stop,
+                'text_feedback__answer.started': start}
+        rows.append(row)
+        if i==n_sequence//2:
+            start, stop = routine(20)
+            rows.append({'break_2.started': start, 'break_2.stopped': stop})
+
+    rows.append({'trials.thisN': 1})
+    start, stop = routine(5)
+    rows.append({'instruct_end.started': start, 'instruct_end.stopped': stop})
+
+    df = pd.DataFrame(rows)
+    df['participant'] = os.path.basename(basename).split('_')[0]
+    df['date'] = '2023-11-14_10h31.25.123'
+    df.to_csv(basename + '.csv', index=False)
+    with open(basename + '.log', 'w') as f:
+        f.write('0.0000 \tEXP \tCreated window = Window(...)\n')
+        for time, message in sorted(log, key=lambda x: x[0]):
+            f.write(f'{time:.4f} \tEXP \t{message}\n')
+            f.write(f'{time:.4f} \tDATA \tKeypress: r\n')
+    return basename + '.csv'
+
+
+def make_info(sfreq=1000.):
+    """info of a Neuromag recording (102 magnetometers, 204 gradiometers,
+    three BIO channels and STI101), with sensor positions on a sphere.
+    Used if template-info.fif isn't available"""
+    positions = [f'{group:02d}{pos}' for group in range(1, 27) for pos in range(1, 5)][:102]
+    names, types = [], []
+    for pos in positions:
+        names += [f'MEG{pos}1', f'MEG{pos}2', f'MEG{pos}3']
+        types += ['mag', 'grad', 'grad']
+    names += ['BIO001', 'BIO002', 'BIO003', 'STI101']
+    types += ['bio', 'bio', 'bio', 'stim']
+    info = mne.create_info(names, sfreq, types)
+
+    # positions evenly spread over the upper half of a sphere
+    i = np.arange(len(positions))
+    z = 1 - i / (len(positions) - 1)
+    r = np.sqrt(1 - z**2)
+    golden = np.pi * (3 - np.sqrt(5))
+    locs = np.c_[r*np.cos(golden*i), r*np.sin(golden*i), z] * 0.12
+    coils = [FIFF.FIFFV_COIL_VV_MAG_T3, FIFF.FIFFV_COIL_VV_PLANAR_T1, FIFF.FIFFV_COIL_VV_PLANAR_T1]
+    with info._unlock():
+        for k, loc in enumerate(locs):
+            normal = loc / np.linalg.norm(loc)
+            ex = np.cross(normal, [0, 0, 1.]) if abs(normal[2])<.99 else np.array([1., 0, 0])
+            ex /= np.linalg.norm(ex)
+            ey = np.cross(normal, ex)
+            for j, coil in enumerate(coils):
+                ch = info['chs'][3*k + j]
+                ch['coil_type'] = coil
+                ch['coord_frame'] = FIFF.FIFFV_COORD_DEVICE
+                ch['loc'][:12] = np.r_[loc + [0, 0, 0.04], ex if j!=2 else ey,
+                                       ey if j!=2 else -ex, normal]
+        info['dev_head_t'] = mne.transforms.Transform('meg', 'head', np.eye(4))
+
+    rng = np.random.default_rng(0)
+    hsp = rng.normal(size=(200, 3))
+    hsp = hsp / np.linalg.norm(hsp, axis=1)[:, None] * 0.09
+    hsp[:, 2] = np.abs(hsp[:, 2])
+    montage = mne.channels.make_dig_montage(nasion=[0, 0.09, 0], lpa=[-0.08, 0, 0],
+                                            rpa=[0.08, 0, 0], hsp=hsp, coord_frame='head')
+    with info._unlock():
+        info['dig'] = montage.dig
+    return info
+
+
+def make_raw_fif(fif_file, info, duration, events=(), missing=(), date=meas_date, seed=0):
+    """write a recording with noise on all channels and triggers on STI101.
+
+    Parameters
+    ----------
+    fif_file : file to write
+    info : channels of the recording, e.g. of template-info.fif
+    duration : length of the recording in seconds
+    events : list of (time in seconds, trigger value)
+    missing : channels to leave out, e.g. ['MEG2112', 'BIO003']
+    date : measurement date as unix time
+    """
+    info = info.copy()
+    info = mne.pick_info(info, [i for i, ch in enumerate(info.ch_names) if ch not in missing])
+    n_times = int(duration * info['sfreq'])
+    rng = np.random.default_rng(seed)
+    data = rng.standard_normal((len(info.ch_names), n_times), dtype=np.float32)
+    data *= 1e-12
+    stim = info.ch_names.index('STI101')
+    data[stim] = 0
+    for time, value in events:
+        sample = int(round(time * info['sfreq']))
+        data[stim, sample:sample + 5] = value
+    raw = mne.io.RawArray(data, info, verbose='ERROR')
+    raw.set_meas_date(date)
+    os.makedirs(os.path.dirname(os.path.abspath(fif_file)), exist_ok=True)
+    raw.save(fif_file, overwrite=True, verbose='ERROR')
+    return fif_file
+
+
+def main_triggers(df, offset=7.0):
+    """triggers of the main task that belong to the behavioural events of
+    a run (localizer images, cues and sequence images), as they would be
+    recorded `offset` seconds after the MEG recording started"""
+    values = alignment.expected_triggers(df)
+    onsets = df['onset'].to_numpy(float)[values>0] + offset
+    return list(zip(onsets, values[values>0]))
+
+
+def make_raw_folder(root, info, subjects=('01',), n_localizer=40, n_sequence=15,
+                    rest_duration=20, missing=()):
+    """write a raw data folder with the layout of highspeed-MEG-raw.
+
+    Every subject gets two resting states, a behavioural run and a main
+    recording with the matching triggers. Two empty rooms are written, one
+    on the recording day of the first subject.
+
+    Returns
+    -------
+    root
+    """
+    for i, subj in enumerate(subjects):
+        date = meas_date + i*7*86400
+        meg_dir = f'{root}/data-MEG/mfr_{subj}'
+        log_dir = f'{root}/data-logs/MFR-{subj}'
+        os.makedirs(log_dir, exist_ok=True)
+        for rs in [1, 2]:
+            make_raw_fif(f'{meg_dir}/MFR{subj}_rs{rs}_trans_tsss.fif', info, rest_duration,
+                         [(1, 1), (rest_duration - 1, 2)], missing, date, seed=i)
+        csv_file = make_psychopy_run(f'{log_dir}/{subj}_main_2023-11-14_10h31.25.123',
+                                     n_localizer, n_sequence, seed=i)
+        events = main_triggers(events_conversion.convert_psychopy_to_bids(csv_file))
+        make_raw_fif(f'{meg_dir}/MFR{subj}_main_trans[MFR{subj}_main]_tsss_mc.fif', info,
+                     events[-1][0] + 10, events, missing, date, seed=i)
+
+    for er_date, date in [('20231114', meas_date - 3600), ('20231122', meas_date + 8*86400)]:
+        make_raw_fif(f'{root}/data-empty-room/emptyroom_{er_date}_01.fif', info, 10,
+                     date=date)
+    return root